@@ -1,19 +1,47 @@
 from pepnets.PeptideClusters import PeptideClusters
 import pandas as pd
 import numpy as np
+from scipy import sparse as sp
+
+from pepnets.SampleStore import SampleStore
+
+metadata_columns = ["Protein", "Start", "End", "Peptide", "Mods", "id", "Cluster"]
+feature_names = ["n_peptides", "intensity", "max_intensity", "detection_frequency"]
+store_chunk_size = 32
 
 
 class FeatureMatrix:
     def __init__(
         self,
-        datamatrix: pd.DataFrame,
+        datamatrix,
         clusters: PeptideClusters,
+        dtype=None,
+        sparse: bool = False,
     ):
-        self.datamatrix = datamatrix.replace(0, np.nan)
+        """
+        Assigns each peptide in the datamatrix (a DataFrame or a SampleStore) to
+        its cluster. dtype (e.g. np.float32) sets the intensity dtype. With
+        sparse=True the intensities are kept in a CSR matrix (self.intensities)
+        where missing and zero values are not stored, and self.datamatrix only
+        holds the peptide annotations. A SampleStore is not loaded; self.store
+        reads its intensities for the assigned peptides, store_chunk_size
+        samples at a time.
+        """
         self.clusters = clusters
+        self.sparse = sparse
+        self.dtype = dtype
+        self.store = None
         self.samples = [col for col in datamatrix.columns if "Sample" in col]
-        self.peptides = datamatrix["Peptide"].values.tolist()
-        self.proteins = datamatrix["Protein"].values.tolist()
+        if isinstance(datamatrix, SampleStore):
+            annotations = datamatrix.metadata
+            self.intensity_columns = datamatrix.samples
+        else:
+            annotations = datamatrix
+            self.intensity_columns = [
+                col for col in datamatrix.columns if col not in metadata_columns
+            ]
+        self.peptides = annotations["Peptide"].values.tolist()
+        self.proteins = annotations["Protein"].values.tolist()
         cluster_column = []
         for protein, peptide in zip(self.proteins, self.peptides):
             cluster = clusters.get_cluster(peptide, protein)
@@ -22,53 +50,211 @@ class FeatureMatrix:
             else:
                 cluster_column.append(np.nan)
 
+        if sparse:
+            self.intensities = get_sparse_intensities(
+                datamatrix, self.intensity_columns, dtype=dtype
+            )
+            self.datamatrix = annotations[
+                [col for col in annotations.columns if col in metadata_columns]
+            ].copy()
+        elif isinstance(datamatrix, SampleStore):
+            self.datamatrix = annotations.copy()
+        else:
+            self.datamatrix = datamatrix.replace(0, np.nan)
+            if dtype is not None:
+                self.datamatrix[self.intensity_columns] = self.datamatrix[
+                    self.intensity_columns
+                ].astype(dtype)
+
         self.datamatrix["Cluster"] = cluster_column
         pre_drop = len(self.datamatrix.index)
-        self.datamatrix = self.datamatrix.dropna(subset=["Cluster"])
+        assigned = self.datamatrix["Cluster"].notna().to_numpy()
+        self.datamatrix = self.datamatrix[assigned]
+        if sparse:
+            self.intensities = self.intensities[assigned]
+        elif isinstance(datamatrix, SampleStore):
+            self.store = datamatrix.subset(np.flatnonzero(assigned), self.datamatrix)
         print("Dropped: ", pre_drop - len(self.datamatrix.index))
+        self._assignment = None
+
+    def _get_intensities(self):
+        """
+        Yields the intensities in column chunks: all columns at once, or
+        store_chunk_size samples at a time from a store
+        """
+        if self.sparse:
+            yield self.intensities
+        elif self.store is not None:
+            for start in range(0, len(self.intensity_columns), store_chunk_size):
+                samples = self.intensity_columns[start : start + store_chunk_size]
+                yield np.asarray(self.store.get_samples(samples), dtype=self.dtype)
+        else:
+            yield self.datamatrix[self.intensity_columns].values
 
-    def get_topn(self):
-        datamatrix = self.datamatrix.copy()
-        datamatrix = datamatrix.drop(
-            columns=["Protein", "Start", "End", "Peptide", "Mods", "id"]
+    def get_datamatrix(self):
+        """
+        Returns the datamatrix with dense intensity columns, NaN where missing
+        """
+        if self.store is not None:
+            return self.store.to_dataframe()
+        if not self.sparse:
+            return self.datamatrix
+        intensities = self.intensities.toarray()
+        intensities[intensities == 0] = np.nan
+        return pd.concat(
+            [
+                self.datamatrix,
+                pd.DataFrame(
+                    intensities,
+                    index=self.datamatrix.index,
+                    columns=self.intensity_columns,
+                ),
+            ],
+            axis=1,
         )
-        clusters = self.datamatrix["Cluster"].unique()
 
-        quantifications = {}
+    def get_topn(self, top_n: int = 3, summarization_method: str = "sum"):
+        """
+        Quantifies each cluster per sample from its top_n most intense peptides,
+        summarized with "sum", "mean" or "median". The rows are sorted by
+        cluster once and each cluster is a contiguous segment.
+        """
+        clusters, codes, _ = self._get_assignment()
+        order = np.argsort(codes, kind="stable")
+        boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(order)]])
 
-        for cluster in clusters:
-            dm = (
-                datamatrix[datamatrix["Cluster"] == cluster]
-                .copy()
-                .set_index(["Cluster"])
+        quantifications = []
+        for intensities in self._get_intensities():
+            intensities = intensities[order]
+            chunk = []
+            for start, end in zip(starts, ends):
+                group = intensities[start:end]
+                if sp.issparse(group):
+                    group = group.toarray()
+                chunk.append(quantify_group(group, summarization_method, top_n))
+            quantifications.append(np.array(chunk))
+
+        q = pd.DataFrame(
+            np.hstack(quantifications), index=clusters, columns=self.intensity_columns
+        )
+        return q
+
+    def _get_assignment(self):
+        """
+        Returns the clusters, the cluster code of each row and a sparse
+        (cluster x peptide) assignment matrix, built once per FeatureMatrix
+        """
+        if self._assignment is None:
+            codes, clusters = pd.factorize(self.datamatrix["Cluster"])
+            assignment = sp.csr_matrix(
+                (np.ones(len(codes)), (codes, np.arange(len(codes)))),
+                shape=(len(clusters), len(codes)),
             )
-            quantification = quantify_group(dm.values)
+            self._assignment = clusters, codes, assignment
+        return self._assignment
+
+    def get_features(self, features: list = ["n_peptides", "intensity"]):
+        """
+        Computes cluster features per sample: "n_peptides" (detected peptides),
+        "intensity" (summed), "max_intensity" and "detection_frequency" (the
+        fraction of the cluster's peptides that are detected). Rows are named
+        {cluster}_{feature}, as in PeptideClusters.to_feature_edgelist.
+        """
+        unknown = [f for f in features if f not in feature_names]
+        if unknown:
+            raise ValueError(f"Unknown features: {unknown}")
+        clusters, codes, assignment = self._get_assignment()
+        stacked = np.concatenate(
+            [
+                get_cluster_features(intensities, features, codes, assignment)
+                for intensities in self._get_intensities()
+            ],
+            axis=2,
+        )
+        index = [f"{cluster}_{feature}" for cluster in clusters for feature in features]
+        return pd.DataFrame(
+            stacked.reshape(-1, stacked.shape[2]),
+            index=index,
+            columns=self.intensity_columns,
+        )
 
-            quantifications[cluster] = quantification
 
-        datamatrix = datamatrix.set_index(["Cluster"])
-        q = pd.DataFrame(quantifications).T
-        q.columns = datamatrix.columns
-        return q
+def get_cluster_features(intensities, features, codes, assignment):
+    """
+    Returns the (cluster x feature x sample) array of features for one column
+    chunk of intensities
+    """
+    if not sp.issparse(intensities):
+        intensities = sp.csr_matrix(np.nan_to_num(intensities, nan=0.0))
+
+    computed = {}
+    if "intensity" in features:
+        computed["intensity"] = (assignment @ intensities).toarray()
+    if "n_peptides" in features or "detection_frequency" in features:
+        detected = intensities.copy()
+        detected.data = np.ones_like(detected.data)
+        computed["n_peptides"] = (assignment @ detected).toarray()
+    if "detection_frequency" in features:
+        cluster_sizes = np.asarray(assignment.sum(axis=1))
+        computed["detection_frequency"] = computed["n_peptides"] / cluster_sizes
+    if "max_intensity" in features:
+        max_intensity = np.zeros((assignment.shape[0], intensities.shape[1]))
+        entries = intensities.tocoo()
+        np.maximum.at(
+            max_intensity,
+            (codes[entries.row], entries.col),
+            entries.data,
+        )
+        computed["max_intensity"] = max_intensity
+
+    return np.stack([computed[f] for f in features], axis=1)
+
+
+def get_sparse_intensities(datamatrix, columns, dtype=None):
+    """
+    Builds a CSR matrix of the intensity columns of a DataFrame or SampleStore
+    one column at a time, leaving out missing and zero values
+    """
+    dtype = np.float64 if dtype is None else dtype
+    rows, cols, data = [], [], []
+    for j, column in enumerate(columns):
+        if isinstance(datamatrix, SampleStore):
+            values = np.asarray(datamatrix.get_samples([column])[:, 0], dtype=dtype)
+        else:
+            values = datamatrix[column].to_numpy(dtype=dtype)
+        present = np.flatnonzero(~np.isnan(values) & (values != 0))
+        rows.append(present)
+        cols.append(np.full(len(present), j))
+        data.append(values[present])
+    return sp.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(datamatrix), len(columns)),
+        dtype=dtype,
+    )
 
 
 def quantify_group(
-    group_data: np.ndarray, summarization_method: str = "sum"
+    group_data: np.ndarray, summarization_method: str = "sum", top_n: int = 3
 ) -> np.ndarray:
-    top_n = 3
     group_data = np.nan_to_num(group_data, nan=0.0)
 
-    sort_indices = np.argsort(group_data, axis=0)[::-1]
-
-    sorted_precursors = np.take_along_axis(group_data, sort_indices, axis=0)
+    if len(group_data) > top_n:
+        group_data = np.partition(group_data, len(group_data) - top_n, axis=0)
+        group_data = group_data[-top_n:]
+    sorted_precursors = np.sort(group_data, axis=0)[::-1]
 
     if summarization_method == "sum":
-        quantification: np.ndarray = np.sum(sorted_precursors[:top_n], axis=0)
+        quantification: np.ndarray = np.sum(sorted_precursors, axis=0)
 
     elif summarization_method == "mean":
-        quantification: np.ndarray = np.mean(sorted_precursors[:top_n], axis=0)
+        quantification: np.ndarray = np.mean(sorted_precursors, axis=0)
 
     elif summarization_method == "median":
-        quantification: np.ndarray = np.median(sorted_precursors[:top_n], axis=0)
+        quantification: np.ndarray = np.median(sorted_precursors, axis=0)
+
+    else:
+        raise ValueError(f"Unknown summarization method {summarization_method}")
 
     return quantification
@@ -1,9 +1,13 @@
 import numpy as np
 import pandas as pd
 from pepnets.palette import *
+from pepnets.parallel import map_largest_first
+from pepnets.ProteinIndex import get_protein_index
+from pepnets.SampleStore import get_datamatrix
 import seaborn as sns
 import logomaker
 from collections import Counter
+from scipy import sparse as sp
 
 
 amino_acids = list("ARNDBCEQZGHILKMFPSTWYV*")
@@ -11,6 +15,9 @@ amino_acids = list("ARNDBCEQZGHILKMFPSTWYV*")
 sns.color_palette("BuPu")
 
 positions = ["p4", "p3", "p2", "p1", "p1'", "p2'", "p3'", "p4'"]
+flank_offsets = np.arange(-5, 3)
+residue_codes = {aa: code for code, aa in enumerate(amino_acids)}
+_permutation_data = ()
 color_scheme = {aa: "#e3e3e3" for aa in amino_acids}
 color_scheme.update(
     {
@@ -40,6 +47,7 @@ class LogoPlot:
         self.dm = datamatrix
         self.design = design
         self.database = database
+        self.protein_index = get_protein_index(database)
         self.species = species
         self.topn = topn
         self.weight = weight
@@ -48,6 +56,97 @@ class LogoPlot:
     def get_letter_heights(self, test_samples: list, background_samples: list):
         test_nc = self.get_nc(test_samples)
         back_nc = self.get_nc(background_samples)
+        return self._get_height(test_nc, back_nc)
+
+    def get_contrast_heights(self, contrasts: list) -> list:
+        """
+        Returns the letter heights of each (test_samples, background_samples)
+        pair in contrasts, with the cluster flanks extracted once for all pairs
+        """
+        sample_sets = [list(samples) for contrast in contrasts for samples in contrast]
+        samples = list(dict.fromkeys(sample for s in sample_sets for sample in s))
+        counts, assignment, intensities = self._prepare_contrasts(samples)
+        indicator = np.array(
+            [
+                [sample in sample_set for sample_set in sample_sets]
+                for sample in samples
+            ],
+            dtype=float,
+        )
+        frequencies = get_weighted_frequencies(
+            counts, assignment, intensities, indicator, weight=self.weight
+        )
+        ncs = [self._normalize(frequency) for frequency in frequencies]
+        return [
+            self._get_height(test_nc, back_nc)
+            for test_nc, back_nc in zip(ncs[0::2], ncs[1::2])
+        ]
+
+    def get_permutation_test(
+        self,
+        test_samples: list,
+        background_samples: list,
+        n_permutations: int = 1000,
+        random_seed: int = 42,
+        n_jobs: int = 1,
+        batch_size: int = 50,
+    ):
+        """
+        Returns the letter heights of test_samples against background_samples
+        and their p-values from shuffling the sample labels n_permutations times
+        """
+        samples = list(test_samples) + list(background_samples)
+        n_test = len(test_samples)
+        counts, assignment, intensities = self._prepare_contrasts(samples)
+        drop = self.drop if self.drop else []
+        keep = np.array([aa not in drop for aa in amino_acids])
+
+        observed = get_permuted_heights(
+            counts,
+            assignment,
+            intensities,
+            np.arange(len(samples))[None],
+            n_test,
+            keep,
+            weight=self.weight,
+        )[:, :, 0]
+        rng = np.random.default_rng(random_seed)
+        permutations = rng.permuted(
+            np.tile(np.arange(len(samples)), (n_permutations, 1)), axis=1
+        )
+        batches = [
+            permutations[i : i + batch_size]
+            for i in range(0, n_permutations, batch_size)
+        ]
+        try:
+            exceedances = map_largest_first(
+                _get_batch_exceedances,
+                [(batch,) for batch in batches],
+                sizes=[len(batch) for batch in batches],
+                n_jobs=n_jobs,
+                initializer=_set_permutation_data,
+                initargs=(
+                    counts,
+                    assignment,
+                    intensities,
+                    n_test,
+                    keep,
+                    observed,
+                    self.weight,
+                ),
+            )
+        finally:
+            _set_permutation_data()
+        p_values = (1 + np.sum(exceedances, axis=0)) / (1 + n_permutations)
+
+        index = pd.Index([-4, -3, -2, -1, 1, 2, 3, 4], name="index")
+        columns = [aa for aa, kept in zip(amino_acids, keep) if kept]
+        return (
+            pd.DataFrame(observed, index=index, columns=columns),
+            pd.DataFrame(p_values, index=index, columns=columns),
+        )
+
+    def _get_height(self, test_nc, back_nc):
         height = get_height_from_norm(test_nc, back_nc)
         height["index"] = [-4, -3, -2, -1, 1, 2, 3, 4]
         height.set_index("index", inplace=True)
@@ -59,7 +158,9 @@ class LogoPlot:
     def get_nc(self, samples: list):
         n, c = self._prepare_data(samples)
         nc = pd.concat([n, c])
-        nc_freq = self.get_frequency_dict(nc)
+        return self._normalize(self.get_frequency_dict(nc))
+
+    def _normalize(self, nc_freq):
         if self.drop:
             nc_freq = nc_freq.drop(index=self.drop)
         nc = nc_freq / nc_freq.sum(axis=0)
@@ -69,10 +170,20 @@ class LogoPlot:
         """
         Return two dataframes for the n-term and c-term respectively
         """
-        dm = self.dm.copy()
-        dm["mean_int"] = dm[samples].mean(axis=1)
-        dm = dm[dm["mean_int"] > 0].copy()
-        dm = dm[["Cluster", "Protein", "Start", "End", "mean_int"]]
+        dm = get_datamatrix(self.dm, samples)
+        mean_int = dm[samples].mean(axis=1)
+        dm = dm.loc[mean_int > 0, ["Cluster", "Protein", "Start", "End"]].assign(
+            mean_int=mean_int[mean_int > 0]
+        )
+        dm = self._get_cluster_endpoints(dm)
+        n_term = self._get_flanks(dm, term="n")
+        c_term = self._get_flanks(dm, term="c")
+        n_term.drop(columns={"Start", "End", "Cluster"}, inplace=True)
+        c_term.drop(columns={"Start", "End", "Cluster"}, inplace=True)
+
+        return n_term, c_term
+
+    def _get_cluster_endpoints(self, dm):
         dm = dm.groupby(["Cluster", "Protein"], as_index=False).agg(
             {
                 "Start": lambda x:  min(x) if max(Counter(x).values()) == 1 else max(list(x), key=list(x).count),
@@ -80,41 +191,107 @@ class LogoPlot:
                 "mean_int": "mean",
             }
         )
-        dm = dm[["Cluster", "Start", "Protein", "End", "mean_int"]]
-        n_term = self._get_flanks(dm, term="n")
-        c_term = self._get_flanks(dm, term="c")
-        n_term.drop(columns={"Start", "End", "Cluster"}, inplace=True)
-        c_term.drop(columns={"Start", "End", "Cluster"}, inplace=True)
+        return dm[["Cluster", "Start", "Protein", "End", "mean_int"]]
 
-        return n_term, c_term
+    def _prepare_contrasts(self, samples: list):
+        """
+        Returns, for the clusters detected in any of samples, a sparse (cluster x
+        position * amino acid) matrix counting the residues in their n- and
+        c-term flanks, the sparse (cluster x peptide) assignment matrix and the
+        (peptide x sample) intensities
+        """
+        dm = get_datamatrix(self.dm, samples)
+        mean_int = dm[samples].mean(axis=1)
+        dm = dm.loc[mean_int > 0]
+        clusters = self._get_cluster_endpoints(
+            dm[["Cluster", "Protein", "Start", "End"]].assign(
+                mean_int=mean_int[mean_int > 0]
+            )
+        )
+
+        codes = np.concatenate(
+            [
+                get_residue_codes(
+                    self.get_flank_matrix(
+                        clusters["Protein"].values,
+                        clusters[start_or_end].astype(int).values + add,
+                    ).T
+                )
+                for start_or_end, add in [("Start", 0), ("End", 1)]
+            ]
+        )
+        rows, columns = np.nonzero(codes >= 0)
+        counts = sp.csr_matrix(
+            (
+                np.ones(len(rows)),
+                (
+                    rows % len(clusters.index),
+                    columns * len(amino_acids) + codes[rows, columns],
+                ),
+            ),
+            shape=(len(clusters.index), len(positions) * len(amino_acids)),
+        )
+
+        cluster_index = pd.MultiIndex.from_frame(clusters[["Cluster", "Protein"]])
+        peptide_clusters = cluster_index.get_indexer(
+            pd.MultiIndex.from_frame(dm[["Cluster", "Protein"]])
+        )
+        assignment = sp.csr_matrix(
+            (
+                np.ones(len(peptide_clusters)),
+                (peptide_clusters, np.arange(len(peptide_clusters))),
+            ),
+            shape=(len(clusters.index), len(peptide_clusters)),
+        )
+        return counts, assignment, dm[samples].to_numpy(dtype=float)
 
     def get_frequency_dict(self, nc, impute=0.0001) -> pd.DataFrame:
         """
         Returns a frequency dict from a frequency dataframe
         """
-        frequency_dict = {}
-
-        for position in positions:
-            frequency_dict[position] = {aa: impute for aa in amino_acids}
-
-        nc["count"] = 1
-        for _, row in nc.iterrows():
-            value = row[self.weight]
-            for position in positions:
-                aa_at_position = row[position]
-                if aa_at_position not in ["X", None]:
-                    frequency_dict[position][aa_at_position] += value
-        return pd.DataFrame(frequency_dict)
+        codes = get_residue_codes(nc[positions].to_numpy())
+        if self.weight == "count":
+            weights = np.ones(len(nc.index))
+        else:
+            weights = nc[self.weight].to_numpy(dtype=float)
+        frequencies = get_frequency_matrix(codes, weights, impute=impute)
+        return pd.DataFrame(frequencies.T, index=amino_acids, columns=positions)
 
     def _get_aa(self, protein, index):
-        sequence = self.database[
-            self.database["Entry Name"].isin([f"{protein}_PIG", f"{protein}_HUMAN"])
-        ]["Sequence"].values[0]
+        sequence = self.protein_index.get_first_sequence(
+            [f"{protein}_PIG", f"{protein}_HUMAN"]
+        )
         try:
             return sequence[index]
         except:
             return None
 
+    def get_flank_matrix(self, proteins, anchors):
+        """
+        Returns the residues at anchor - 5 ... anchor + 2 for each (protein,
+        anchor) pair as a (position x cluster) array of characters, with ""
+        outside the sequence. Each sequence is looked up once and the residues
+        are gathered from one concatenated byte array.
+        """
+        codes, unique_proteins = pd.factorize(np.asarray(proteins, dtype=object))
+        sequences = [
+            self.protein_index.get_first_sequence(
+                [f"{protein}_PIG", f"{protein}_HUMAN"]
+            )
+            for protein in unique_proteins
+        ]
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        residues = np.frombuffer("".join(sequences).encode(), dtype="S1")
+
+        indices = np.asarray(anchors, dtype=np.int64) + flank_offsets[:, None]
+        length = lengths[codes]
+        inside = (indices >= -length) & (indices < length)
+        indices = np.where(indices < 0, indices + length, indices)
+        flanks = np.full(indices.shape, b"", dtype="S1")
+        flanks[inside] = residues[(offsets[codes] + indices)[inside]]
+        return flanks.astype("U1")
+
     def _get_flanks(self, df, term="n"):
         if term == "n":
             start_or_end = "Start"
@@ -123,40 +300,145 @@ class LogoPlot:
             start_or_end = "End"
             add = 1
         df = df.copy()
-        df["p4"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) - 5 + add),
-            axis=1,
-        )
-        df["p3"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) - 4 + add),
-            axis=1,
-        )
-        df["p2"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) - 3 + add),
-            axis=1,
-        )
-        df["p1"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) - 2 + add),
-            axis=1,
+        flanks = self.get_flank_matrix(
+            df["Protein"].values, df[start_or_end].astype(int).values + add
         )
+        for position, residues in zip(positions, flanks):
+            df[position] = np.where(residues == "", None, residues.astype(object))
+        return df
 
-        df["p1'"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) - 1 + add),
-            axis=1,
-        )
-        df["p2'"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) + 0 + add),
-            axis=1,
-        )
-        df["p3'"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) + 1 + add),
-            axis=1,
-        )
-        df["p4'"] = df.apply(
-            lambda row: self._get_aa(row["Protein"], int(row[start_or_end]) + 2 + add),
-            axis=1,
+
+def get_residue_codes(residues):
+    """
+    Maps an array of residues to their index in amino_acids, -1 for "X" and
+    missing residues
+    """
+    residues = np.asarray(residues, dtype=object)
+    residues = np.where(pd.isna(residues), "", residues).astype("U1")
+    unique_residues, inverse = np.unique(residues, return_inverse=True)
+    lookup = np.array(
+        [-1 if aa in ["X", ""] else residue_codes[aa] for aa in unique_residues],
+        dtype=np.int64,
+    )
+    return lookup[inverse].reshape(residues.shape)
+
+
+def get_frequency_matrix(codes, weights, impute=0.0001):
+    """
+    Returns the (position x amino acid) sums of weights, starting from impute,
+    from a (cluster x position) matrix of residue codes
+    """
+    frequencies = np.full((codes.shape[1], len(amino_acids)), impute, dtype=float)
+    rows, columns = np.nonzero(codes >= 0)
+    np.add.at(frequencies, (columns, codes[rows, columns]), weights[rows])
+    return frequencies
+
+
+def get_weighted_frequencies(
+    counts, assignment, intensities, indicator, impute=0.0001, weight="mean_int"
+):
+    """
+    Returns the frequency DataFrame of get_frequency_dict for each sample set,
+    a column of the (sample x sample set) 0/1 matrix indicator
+    """
+    frequencies = get_frequency_arrays(
+        counts, assignment, intensities, indicator, impute=impute, weight=weight
+    )
+    return [
+        pd.DataFrame(frequencies[:, :, k].T, index=amino_acids, columns=positions)
+        for k in range(frequencies.shape[2])
+    ]
+
+
+def get_frequency_arrays(
+    counts, assignment, intensities, indicator, impute=0.0001, weight="mean_int"
+):
+    """
+    Returns the frequencies of get_weighted_frequencies as one (position x
+    amino acid x sample set) array
+    """
+    if weight not in ["mean_int", "count"]:
+        raise ValueError(f"weight must be 'mean_int' or 'count', got {weight}")
+    present = ~np.isnan(intensities)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        peptide_means = (
+            np.nan_to_num(intensities) @ indicator / (present @ indicator)
         )
-        return df
+        detected = peptide_means > 0
+        n_detected = assignment @ detected.astype(float)
+        if weight == "count":
+            weights = (n_detected > 0).astype(float)
+        else:
+            weights = (assignment @ np.where(detected, peptide_means, 0)) / n_detected
+    weights = np.nan_to_num(weights)
+    frequencies = impute + counts.T @ weights
+    return frequencies.reshape(len(positions), len(amino_acids), -1)
+
+
+def get_permutation_exceedances(
+    counts,
+    assignment,
+    intensities,
+    permutations,
+    n_test,
+    keep,
+    observed,
+    weight="mean_int",
+):
+    """
+    Returns, per (position, amino acid), how many of the permutations give a
+    height at least as large as observed. Each row of permutations orders the
+    sample columns of intensities: the first n_test are the test samples and
+    the rest the background. keep masks the amino acids that are not dropped.
+    """
+    heights = get_permuted_heights(
+        counts, assignment, intensities, permutations, n_test, keep, weight=weight
+    )
+    return (heights >= observed[:, :, None]).sum(axis=2)
+
+
+def _set_permutation_data(*data):
+    """
+    Pool initializer: keeps the arrays shared by all permutation batches in
+    the worker, so they are sent once per worker instead of once per batch
+    """
+    global _permutation_data
+    _permutation_data = data
+
+
+def _get_batch_exceedances(permutations):
+    counts, assignment, intensities, n_test, keep, observed, weight = _permutation_data
+    return get_permutation_exceedances(
+        counts,
+        assignment,
+        intensities,
+        permutations,
+        n_test,
+        keep,
+        observed,
+        weight=weight,
+    )
+
+
+def get_permuted_heights(
+    counts, assignment, intensities, permutations, n_test, keep, weight="mean_int"
+):
+    """
+    Returns the (position x amino acid x permutation) letter heights of the
+    test against the background samples of each permutation
+    """
+    n_permutations = len(permutations)
+    indicator = np.zeros((intensities.shape[1], 2 * n_permutations))
+    sets = 2 * np.arange(n_permutations)[:, None]
+    indicator[permutations[:, :n_test], sets] = 1
+    indicator[permutations[:, n_test:], sets + 1] = 1
+    frequencies = get_frequency_arrays(
+        counts, assignment, intensities, indicator, weight=weight
+    )
+    frequencies = frequencies[:, keep]
+    nc = frequencies / frequencies.sum(axis=1, keepdims=True)
+    p, q = nc[:, :, 0::2], nc[:, :, 1::2]
+    return p * (p * np.log2(p / q)).sum(axis=1, keepdims=True)
 
 
 def calc_height(p, q):
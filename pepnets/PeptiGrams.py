@@ -3,6 +3,8 @@ import seaborn as sns
 import numpy as np
 import matplotlib
 
+from pepnets.SampleStore import SampleStore, get_datamatrix
+
 
 class PeptiGram:
     def __init__(self, dm, design):
@@ -23,15 +25,21 @@ class PeptiGram:
         save_str : str = None
     ):
         plt.rcParams.update({'font.size': 16*size_factor})
-        data = self.dm
-        data["Protein"] = data["Cluster"].apply(lambda x: x.split("_")[0])
-        data = data[data["Protein"] == protein].copy().reset_index()
         design = self.design
         design = design[design["group"].isin(groups)]
         design = design[design["day"].isin(days)]
 
         all_samples = design[design["day"].isin(days)]["sample"].values
 
+        data = self.dm
+        if isinstance(data, SampleStore):
+            cluster_proteins = data.metadata["Cluster"].apply(lambda x: x.split("_")[0])
+            rows = np.flatnonzero(cluster_proteins.to_numpy() == protein)
+            data = data.subset(rows, data.metadata.iloc[rows])
+        data = get_datamatrix(data, all_samples)
+        data["Protein"] = data["Cluster"].apply(lambda x: x.split("_")[0])
+        data = data[data["Protein"] == protein].copy().reset_index()
+
         min_start = min(data["Start"].astype(int))
         max_end = max(data["End"].astype(int))
 
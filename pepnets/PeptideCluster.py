@@ -7,65 +7,96 @@ class PeptideCluster:
         self.id = cluster_id
         self.peptides = peptides
         self.protein = protein
-        self.n_peptides = len(peptides)
-        self.peptide_sequences = self._get_unique_peptides()
-        self.start, self.end = self._get_endpoints()
-        self.inter_cluster_distance = self._get_inter_cluster_distance()
+        self._starts = Counter()
+        self._ends = Counter()
+        self._sequences = Counter()
+        for peptide in peptides:
+            self._count(peptide)
+        self._changed()
 
-    def _get_unique_peptides(self):
-        peptides = set()
-        for peptide in self.peptides:
-            peptides.add(peptide.sequence)
-        return list(peptides)
+    def _count(self, peptide, n=1):
+        for counter, key in [
+            (self._starts, peptide.start),
+            (self._ends, peptide.end),
+            (self._sequences, peptide.sequence),
+        ]:
+            counter[key] += n
+            if counter[key] == 0:
+                del counter[key]
+
+    def _changed(self):
+        self.n_peptides = len(self.peptides)
+        self._endpoints = None
+        self._inter_cluster_distance = None
+
+    @property
+    def peptide_sequences(self):
+        return list(self._sequences)
+
+    @property
+    def start(self):
+        if self._endpoints is None:
+            self._endpoints = self._get_endpoints()
+        return self._endpoints[0]
+
+    @property
+    def end(self):
+        if self._endpoints is None:
+            self._endpoints = self._get_endpoints()
+        return self._endpoints[1]
+
+    @property
+    def inter_cluster_distance(self):
+        if self._inter_cluster_distance is None:
+            self._inter_cluster_distance = self._get_inter_cluster_distance()
+        return self._inter_cluster_distance
 
     def _get_endpoints(self, method="mode"):
-        starts = []
-        ends = []
-        for peptide in self.peptides:
-            starts.append(peptide.start)
-            ends.append(peptide.end)
         if len(self.peptides) == 0:
             return 0, 0
         if method == "mode":
-            start_counter = Counter(starts)
-            end_counter = Counter(ends)
-            if max(start_counter.values()) == 1:
-                start = min(starts)
+            if max(self._starts.values()) == 1:
+                start = min(self._starts)
             else:
-                start = max(set(starts), key=starts.count)
-            if max(end_counter.values()) == 1:
-                end = max(ends)
+                start = max(set(self._starts), key=self._starts.get)
+            if max(self._ends.values()) == 1:
+                end = max(self._ends)
             else:
-                end = max(set(ends), key=ends.count)
+                end = max(set(self._ends), key=self._ends.get)
             return start, end
         elif method == "longest":
-            return min(starts), max(ends)
+            return min(self._starts), max(self._ends)
 
     def add_peptide(self, peptide):
-        self.peptides.append(peptide)
-        self.n_peptides = len(self.peptides)
-        self.peptide_sequences = self._get_unique_peptides()
-        self.start, self.end = self._get_endpoints()
+        self.add_peptides([peptide])
+
+    def add_peptides(self, peptides):
+        for peptide in peptides:
+            self.peptides.append(peptide)
+            self._count(peptide)
+        self._changed()
 
     def remove_peptide(self, peptide_to_remove):
-        new_peptides = [
-            peptide
-            for peptide in self.peptides
-            if peptide.sequence != peptide_to_remove.sequence
-        ]
+        new_peptides = []
+        for peptide in self.peptides:
+            if peptide.sequence != peptide_to_remove.sequence:
+                new_peptides.append(peptide)
+            else:
+                self._count(peptide, n=-1)
         self.peptides = new_peptides
-        self.n_peptides = len(self.peptides)
-        self.peptide_sequences = self._get_unique_peptides()
-        self.start, self.end = self._get_endpoints()
+        self._changed()
 
     def _get_inter_cluster_distance(self):
-        center_distance = 0
-        n_distances = 0
-        for peptide1 in self.peptides:
-            for peptide2 in self.peptides:
-                center_distance += np.abs(peptide1.center - peptide2.center)
-                n_distances += 1
-        return center_distance / n_distances
+        """
+        Mean absolute center distance over all ordered pairs of peptides,
+        computed from the sorted centers in O(n log n)
+        """
+        n = len(self.peptides)
+        if n == 0:
+            return 0
+        centers = np.sort([peptide.center for peptide in self.peptides])
+        weights = 2 * np.arange(n) - n + 1
+        return 2 * np.dot(weights, centers) / n**2
 
     def is_empty(self):
         if len(self.peptides) == 0:
@@ -1,10 +1,45 @@
+import os
+
+import numpy as np
 import pandas as pd
 
+from pepnets.Peptide import Peptide
+from pepnets.PeptideCluster import PeptideCluster
+from pepnets.ProteinIndex import get_protein_index
+
 class PeptideClusters:
     def __init__(self, clusters: list()):
         self.clusters = clusters
         self.n_clusters = len(clusters)
         self.proteins = self.get_proteins()
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """
+        Indexes clusters by id and by (protein, peptide sequence). Each key maps
+        to its clusters in list order, so lookups return the first match.
+        """
+        self._clusters_by_id = {}
+        self._clusters_by_peptide = {}
+        for cluster in self.clusters:
+            self._index_cluster(cluster)
+
+    def _index_cluster(self, cluster):
+        self._clusters_by_id.setdefault(cluster.id, []).append(cluster)
+        for sequence in cluster.peptide_sequences:
+            self._clusters_by_peptide.setdefault(
+                (cluster.protein, sequence), []
+            ).append(cluster)
+
+    def _unindex_cluster(self, cluster):
+        keys = [(self._clusters_by_id, cluster.id)] + [
+            (self._clusters_by_peptide, (cluster.protein, sequence))
+            for sequence in cluster.peptide_sequences
+        ]
+        for index, key in keys:
+            index[key].remove(cluster)
+            if len(index[key]) == 0:
+                del index[key]
 
     def reindex(self):
         clusters = self.clusters
@@ -16,6 +51,7 @@ class PeptideClusters:
             for i, cluster in enumerate(pr_cl):
                 cluster.id = f"{protein}_{i}"
         self.clusters = clusters
+        self._build_indexes()
 
     def get_proteins(self):
         proteins = []
@@ -24,9 +60,8 @@ class PeptideClusters:
         return sorted(list(set(proteins)))
 
     def get_cluster_by_id(self, cluster_id: str):
-        for cluster in self.clusters:
-            if cluster_id == cluster.id:
-                return cluster
+        if cluster_id in self._clusters_by_id:
+            return self._clusters_by_id[cluster_id][0]
         print(f"cluster {cluster_id} not found")
         return None
 
@@ -36,30 +71,50 @@ class PeptideClusters:
     ):
         self.clusters.append(cluster)
         self.n_clusters = len(self.clusters)
+        self._index_cluster(cluster)
 
     def remove_cluster(self, cluster):
         self.clusters.remove(cluster)
         self.n_clusters = len(self.clusters)
+        self._unindex_cluster(cluster)
 
     def merge_nearby_clusters(self, wiggle_room=5):
-        c = 0
-        for cluster1 in self.clusters:
-            start1 = cluster1.start
-            end1 = cluster1.end
-            protein = cluster1.protein
-            clusters_in_same_protein = [
-                cluster for cluster in self.clusters if protein == cluster.protein
-            ]
+        """
+        Merges clusters in the same protein whose starts and ends both differ by
+        at most wiggle_room. Merging is transitive; each group of nearby clusters
+        is merged into the one that comes first in the list.
+        """
+        clusters_by_protein = {}
+        for index, cluster in enumerate(self.clusters):
+            clusters_by_protein.setdefault(cluster.protein, []).append(index)
+
+        parent = list(range(len(self.clusters)))
+        for indices in clusters_by_protein.values():
+            by_position = sorted(
+                indices, key=lambda i: (self.clusters[i].start, self.clusters[i].end)
+            )
+            for a, index1 in enumerate(by_position):
+                cluster1 = self.clusters[index1]
+                for b in range(a + 1, len(by_position)):
+                    index2 = by_position[b]
+                    cluster2 = self.clusters[index2]
+                    if cluster2.start - cluster1.start > wiggle_room:
+                        break
+                    if abs(cluster1.end - cluster2.end) <= wiggle_room:
+                        root1, root2 = _find(parent, index1), _find(parent, index2)
+                        parent[max(root1, root2)] = min(root1, root2)
 
-            for cluster2 in clusters_in_same_protein:
-                if cluster1.id is not cluster2.id:
-                    if abs(start1 - cluster2.start) <= wiggle_room:
-                        if abs(end1 - cluster2.end) <= wiggle_room:
-                            for peptide in cluster2.peptides:
-                                cluster1.add_peptide(peptide)
-                                cluster2.remove_peptide(peptide)
-                            self._remove_empty_clusters()
-                            c += 1
+        c = 0
+        merged_clusters = []
+        for index, cluster in enumerate(self.clusters):
+            root = _find(parent, index)
+            if root == index:
+                merged_clusters.append(cluster)
+            else:
+                self.clusters[root].add_peptides(cluster.peptides)
+                c += 1
+        self.clusters = merged_clusters
+        self._remove_empty_clusters()
         print(f"Merged {c} clusters\n")
 
     def _remove_empty_clusters(self):
@@ -73,6 +128,7 @@ class PeptideClusters:
         self.clusters = new_clusters
         self.n_clusters = len(self.clusters)
         self.proteins = self.get_proteins()
+        self._build_indexes()
 
     def remove_small_clusters(self, threshold):
         for n in range(threshold):
@@ -91,6 +147,7 @@ class PeptideClusters:
         self.clusters = new_clusters
         self.n_clusters = len(self.clusters)
         self.proteins = self.get_proteins()
+        self._build_indexes()
 
     def get_n_biggest_clusters(self, n):
         sorted_clusters = sorted(
@@ -99,10 +156,8 @@ class PeptideClusters:
         return sorted_clusters[:n]
 
     def get_cluster(self, peptide, protein, verbose=False):
-        for cluster in self.clusters:
-            if protein == cluster.protein:
-                if peptide in cluster.peptide_sequences:
-                    return cluster
+        if (protein, peptide) in self._clusters_by_peptide:
+            return self._clusters_by_peptide[(protein, peptide)][0]
         if verbose:
             print(f"cluster for {peptide} ({protein}) not found")
         return None
@@ -134,22 +189,77 @@ class PeptideClusters:
                     f"{cluster.id}: ({cluster.start}-{cluster.end})\t{cluster.protein}\n"
                 )
 
-    def _get_aa(self, protein, index, database):
-        sequence = database[database["Entry Name"] == f"{protein}"]["Sequence"].values[0]
-        try:
-            return sequence[index]
-        except:
-            return None
-        
-     
-    def _get_flanks(self, protein, start, end, database):  
-        np1 = self._get_aa(protein, start-1, database)
-        np1p = self._get_aa(protein, start, database)
-        cp1 = self._get_aa(protein, end-1, database)
-        cp1p = self._get_aa(protein, end, database)
+    def save(self, path):
+        """
+        Saves the clusters and their peptides as arrays in an uncompressed .npz file
+        """
+        peptides = [
+            peptide for cluster in self.clusters for peptide in cluster.peptides
+        ]
+        np.savez(
+            get_npz_path(path),
+            cluster_id=np.array([cluster.id for cluster in self.clusters], dtype=str),
+            cluster_protein=np.array(
+                [cluster.protein for cluster in self.clusters], dtype=str
+            ),
+            peptide_offsets=np.cumsum(
+                [0] + [len(cluster.peptides) for cluster in self.clusters],
+                dtype=np.int64,
+            ),
+            peptide_id=np.array([peptide.id for peptide in peptides], dtype=np.int64),
+            peptide_sequence=np.array(
+                [peptide.sequence for peptide in peptides], dtype=str
+            ),
+            peptide_protein=np.array(
+                [peptide.protein for peptide in peptides], dtype=str
+            ),
+            peptide_start=np.array(
+                [peptide.start for peptide in peptides], dtype=np.int64
+            ),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads PeptideClusters saved with save
+        """
+        with np.load(get_npz_path(path), allow_pickle=False) as npz:
+            arrays = {name: npz[name].tolist() for name in npz.files}
+        peptides = [
+            Peptide(sequence, start, protein, id)
+            for id, sequence, protein, start in zip(
+                arrays["peptide_id"],
+                arrays["peptide_sequence"],
+                arrays["peptide_protein"],
+                arrays["peptide_start"],
+            )
+        ]
+        offsets = arrays["peptide_offsets"]
+        return cls(
+            [
+                PeptideCluster(
+                    cluster_id=cluster_id,
+                    peptides=peptides[offsets[i] : offsets[i + 1]],
+                    protein=protein,
+                )
+                for i, (cluster_id, protein) in enumerate(
+                    zip(arrays["cluster_id"], arrays["cluster_protein"])
+                )
+            ]
+        )
+
+    def _get_aa(self, protein, index, protein_index):
+        return protein_index.get_aa(protein, index)
+
+    def _get_flanks(self, protein, start, end, protein_index):
+        np1 = self._get_aa(protein, start-1, protein_index)
+        np1p = self._get_aa(protein, start, protein_index)
+        cp1 = self._get_aa(protein, end-1, protein_index)
+        cp1p = self._get_aa(protein, end, protein_index)
         return np1, np1p, cp1, cp1p
     
     def to_tsv(self, savepath, database):
+        protein_index = get_protein_index(database)
         with open(savepath, "w") as f:
             f.write(f"ID\tProtein\tStart\tEnd\tPeptides\tNp1\tNp1p\tCp1\tCp1p\tLongest\n")
             for cluster in self.clusters:
@@ -158,12 +268,13 @@ class PeptideClusters:
                 protein = cluster.protein
                 peptide_sequences = cluster.peptide_sequences
                 longest_peptide = sorted(peptide_sequences, key=lambda x: len(x), reverse=True)[0]
-                np1, np1p, cp1, cp1p = self._get_flanks(protein, start, end, database)
+                np1, np1p, cp1, cp1p = self._get_flanks(protein, start, end, protein_index)
                 f.write(
                     f"{cluster.id}\t{protein}\t{start}\t{end}\t{peptide_sequences}\t{np1}\t{np1p}\t{cp1}\t{cp1p}\t{longest_peptide}\n"
                 )
 
     def to_df(self, database):
+        protein_index = get_protein_index(database)
         save_dict = {
             "ID": [],
             "Protein": [],
@@ -182,7 +293,7 @@ class PeptideClusters:
             protein = cluster.protein
             peptide_sequences = cluster.peptide_sequences
             longest_peptide = sorted(peptide_sequences, key=lambda x: len(x), reverse=True)[0]
-            np1, np1p, cp1, cp1p = self._get_flanks(protein, start, end, database)
+            np1, np1p, cp1, cp1p = self._get_flanks(protein, start, end, protein_index)
             save_dict["Protein"].append(protein)
             save_dict["Start"].append(start)
             save_dict["End"].append(end)
@@ -201,3 +312,19 @@ class PeptideClusters:
 
     def __iter__(self):
         return self.clusters.__iter__()
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def get_npz_path(path):
+    """
+    Returns path with the .npz suffix np.savez adds, so that save and load
+    agree on the file name
+    """
+    path = os.fspath(path)
+    return path if path.endswith(".npz") else path + ".npz"
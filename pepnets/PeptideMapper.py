@@ -0,0 +1,84 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from pepnets.ProteinIndex import ProteinIndex
+
+
+class PeptideMapper:
+    """
+    Aho-Corasick automaton over a set of peptide sequences. map scans each
+    protein sequence once and finds every occurrence of every peptide, so
+    repeated motifs and peptides shared between proteins are all reported.
+    """
+
+    def __init__(self, peptides):
+        self.peptides = np.array(pd.unique(np.asarray(peptides, dtype=object)))
+        self.lengths = np.fromiter(
+            map(len, self.peptides), dtype=np.int64, count=len(self.peptides)
+        )
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern, peptide in enumerate(self.peptides):
+            state = 0
+            for aa in peptide:
+                if aa not in self.goto[state]:
+                    self.goto[state][aa] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = self.goto[state][aa]
+            self.output[state].append(pattern)
+        self._build_fail_links()
+
+    def _build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for aa, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and aa not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(aa, 0)
+                self.output[next_state] = (
+                    self.output[next_state] + self.output[self.fail[next_state]]
+                )
+
+    def map(self, protein_index: ProteinIndex, proteins: list = None):
+        """
+        Maps the peptides against the proteins of protein_index (or only the
+        given proteins). Returns a DataFrame with Peptide, Protein and Start
+        (0-based) for every occurrence, and an array of unmatched peptides.
+        """
+        if proteins is None:
+            proteins = protein_index.sequences.keys()
+        goto, fail, output = self.goto, self.fail, self.output
+
+        patterns, protein_names, positions = [], [], []
+        for protein in proteins:
+            state = 0
+            for position, aa in enumerate(protein_index.get_sequence(protein)):
+                while state and aa not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(aa, 0)
+                if output[state]:
+                    patterns.extend(output[state])
+                    protein_names.extend([protein] * len(output[state]))
+                    positions.extend([position] * len(output[state]))
+
+        patterns = np.array(patterns, dtype=np.int64)
+        occurrences = pd.DataFrame(
+            {
+                "Peptide": self.peptides[patterns],
+                "Protein": np.array(protein_names, dtype=object),
+                "Start": np.array(positions, dtype=np.int64)
+                - self.lengths[patterns]
+                + 1,
+            }
+        )
+        matched = np.zeros(len(self.peptides), dtype=bool)
+        matched[patterns] = True
+        return occurrences, self.peptides[~matched]
@@ -1,15 +1,20 @@
+import json
+
 import igraph as ig
 import pandas as pd
 import networkx as nx
 import leidenalg
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import seaborn as sns
-import matplotlib.cm as cm
 
 from pepnets.PeptideCluster import PeptideCluster
-from pepnets.PeptideClusters import PeptideClusters
-from pepnets.Peptide import Peptide
+from pepnets.PeptideClusters import PeptideClusters, get_npz_path
+from pepnets.PeptideMapper import PeptideMapper
+from pepnets.PeptideTable import PeptideTable
+from pepnets.ProteinIndex import get_protein_index
+from pepnets.parallel import map_largest_first
 
 
 
@@ -21,186 +26,570 @@ class PeptideNetwork:
         self,
         datamatrix: pd.DataFrame,
         protein_database: pd.DataFrame,
+        backend: str = "networkx",
+        map_occurrences: bool = False,
     ):
+        """
+        With map_occurrences=True every peptide is also mapped against every
+        protein of the database, and all occurrences are kept in
+        self.peptide_occurrences (Peptide, Protein, Start), and the peptides
+        found in no protein in self.unmatched_peptides.
+        """
+        if backend not in ["networkx", "igraph"]:
+            raise ValueError(f"backend must be 'networkx' or 'igraph', got {backend}")
+        self.backend = backend
+        self.map_occurrences = map_occurrences
         self.datamatrix = datamatrix.sort_values("Start", ascending=False)
         self.protein_database = protein_database
+        self.protein_index = get_protein_index(protein_database)
         if protein_database is not None:
             proteins_in_database = protein_database["Entry Name"].values.tolist()
             self.datamatrix = self.datamatrix[
                 self.datamatrix["Protein"].isin(proteins_in_database)
             ]
         self.peptides, self.proteins = self._generate_peptides()
+        self.partitions = {}
+        self.dirty_proteins = {}
+        self.clusters_key = None
+        self._igraphs = {}
+        self._layouts = {}
 
     def _generate_peptides(self):
         print("Reading peptides...")
-        peptides = []
-        proteins = []
-        id = 0
-        total_n_peptides = len(self.datamatrix.index)
-        for _, row in self.datamatrix.iterrows():
-            print(f"{id} / {total_n_peptides}", end="\r")
-            protein = row["Protein"]
-            peptide = row["Peptide"]
-            start = self._get_peptide_start(peptide, row["Protein"])
-            peptides.append(Peptide(peptide, start, protein, id))
-            proteins.append(protein)
-            id += 1
-        proteins = list(set(proteins))
+        columns = self._read_peptides(self.datamatrix)
+        peptides = PeptideTable(
+            columns["id"], columns["sequence"], columns["protein"], columns["start"]
+        )
+        proteins = list(set(columns["protein"]))
         return peptides, proteins
 
+    def _read_peptides(self, datamatrix, first_id=0):
+        """
+        Returns the peptides of datamatrix as a dict of NumPy arrays, with ids
+        numbered from first_id
+        """
+        proteins = datamatrix["Protein"].to_numpy(dtype=object)
+        sequences = datamatrix["Peptide"].to_numpy(dtype=object)
+        starts = self._get_peptide_starts(datamatrix, sequences, proteins)
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        return {
+            "id": np.arange(first_id, first_id + len(sequences)),
+            "sequence": sequences,
+            "protein": proteins,
+            "start": starts,
+            "end": starts + lengths,
+            "length": lengths,
+            "center": starts + lengths / 2,
+        }
 
-    def create_network(self, distance_cutoff: int = 4):
-        protein_networks = {}
-        for protein in self.proteins:
-            peptides_in_protein = [
-                peptide for peptide in self.peptides if peptide.protein == protein
+    def _get_peptide_starts(self, datamatrix, sequences, proteins):
+        if self.protein_index is None:
+            first_starts = datamatrix.drop_duplicates("Peptide").set_index(
+                "Peptide"
+            )["Start"]
+            return first_starts.reindex(sequences).to_numpy(dtype=np.int64)
+        codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([proteins, sequences]))
+        if self.map_occurrences:
+            occurrences, unmatched = PeptideMapper(sequences).map(self.protein_index)
+            self.peptide_occurrences = pd.concat(
+                [getattr(self, "peptide_occurrences", None), occurrences],
+                ignore_index=True,
+            )
+            self.unmatched_peptides = np.concatenate(
+                [getattr(self, "unmatched_peptides", []), unmatched]
+            )
+            first_starts = occurrences.groupby(["Protein", "Peptide"])["Start"].min()
+            unique_starts = first_starts.reindex(pairs, fill_value=-1)
+        else:
+            unique_starts = [
+                self.protein_index.get_sequence(protein).find(sequence)
+                for protein, sequence in pairs
             ]
-            G = nx.Graph()
-            for peptide in peptides_in_protein:
-                G.add_node(
-                    peptide.id,
-                    peptide=peptide.sequence,
-                    protein=peptide.protein,
-                    start=peptide.start,
-                    end=peptide.end,
-                ),
-
-            for i, peptide_from in enumerate(peptides_in_protein):
-                for peptide_to_index in range(i + 1):
-                    peptide_to = peptides_in_protein[peptide_to_index]
-
-                    overlap_percentage = get_overlap_percentage(
-                        peptide_from, peptide_to
+        starts = np.asarray(unique_starts, dtype=np.int64)[codes]
+        n_unmatched = np.count_nonzero(starts == -1)
+        if n_unmatched > 0:
+            print(f"{n_unmatched} peptides not found in their protein sequence.")
+        return starts
+
+    def create_network(self, distance_cutoff: int = 4, n_jobs: int = 1):
+        """
+        Builds one network per protein. With n_jobs > 1 (or -1 for all cores)
+        the networks are built in worker processes, largest protein first.
+        """
+        peptides_by_protein = {
+            protein: self.peptides.get_protein(protein) for protein in self.proteins
+        }
+
+        networks = map_largest_first(
+            build_protein_network,
+            [
+                (peptides, distance_cutoff, self.backend)
+                for peptides in peptides_by_protein.values()
+            ],
+            sizes=[len(peptides) for peptides in peptides_by_protein.values()],
+            n_jobs=n_jobs,
+        )
+        protein_networks = dict(zip(peptides_by_protein.keys(), networks))
+        self.protein_networks = protein_networks
+        self.distance_cutoff = distance_cutoff
+        self.partitions = {}
+        self.dirty_proteins = {}
+        self.clusters_key = None
+        self._igraphs = {}
+        self._layouts = {}
+
+        return protein_networks
+
+    def get_clusters(
+        self,
+        resolution: float,
+        random_seed: int = 42,
+        n_jobs: int = 1,
+        executor: str = "process",
+    ):
+        """
+        Partitions each protein network with Leiden. With n_jobs > 1 the
+        proteins are partitioned on a "process" or "thread" pool. Every protein
+        is seeded with random_seed, so the result does not depend on n_jobs.
+        Partitions are cached per (resolution, random_seed) in self.partitions.
+        """
+        key = (resolution, random_seed)
+        if key not in self.partitions:
+            proteins = self._get_clustered_proteins()
+            partitions = map_largest_first(
+                find_protein_partition,
+                [
+                    (self._get_igraph(protein), resolution, random_seed)
+                    for protein in proteins
+                ],
+                sizes=[self._get_igraph(protein).vcount() for protein in proteins],
+                n_jobs=n_jobs,
+                executor=executor,
+            )
+            self.partitions[key] = dict(zip(proteins, partitions))
+        else:
+            self._update_partitions(key, n_jobs=n_jobs, executor=executor)
+        clusters = self._get_partition_clusters(key)
+        self.clusters = clusters
+        self.clusters_key = key
+        return clusters
+
+    def sweep_resolutions(self, resolutions: list, random_seed: int = 42):
+        """
+        Clusters at each resolution, starting Leiden from the partition at the
+        previous one. Returns the clusters per resolution and a summary
+        """
+        proteins = self._get_clustered_proteins()
+        clusters = {}
+        summary = []
+        previous_key = None
+        previous_resolutions = []
+        for resolution in sorted(resolutions):
+            key = (resolution, random_seed)
+            if previous_resolutions:
+                key = (resolution, random_seed, tuple(previous_resolutions))
+            previous_resolutions.append(resolution)
+            if key not in self.partitions:
+                partitions = {}
+                for protein in proteins:
+                    initial_membership = None
+                    if previous_key is not None:
+                        initial_membership = self.partitions[previous_key][protein][1]
+                    partitions[protein] = find_protein_partition(
+                        self._get_igraph(protein),
+                        resolution,
+                        random_seed,
+                        initial_membership=initial_membership,
                     )
-                    epsilon = 1e-8
+                self.partitions[key] = partitions
+            else:
+                self._update_partitions(key)
+            previous_key = key
 
-                    if peptide_from.sequence == peptide_to.sequence:
-                        continue
-                    if overlap_percentage == 0:
-                        continue
+            clusters[resolution] = self._get_partition_clusters(key)
+            modularities = [
+                self._get_igraph(protein).modularity(membership, weights="distance_inv")
+                for protein, (_, membership) in self.partitions[key].items()
+            ]
+            cluster_sizes = [cluster.n_peptides for cluster in clusters[resolution]]
+            summary.append(
+                {
+                    "resolution": resolution,
+                    "n_clusters": len(cluster_sizes),
+                    "mean_cluster_size": np.mean(cluster_sizes),
+                    "modularity": np.mean(modularities),
+                }
+            )
+        return clusters, pd.DataFrame(summary)
 
-                    overlap_distance = 1 / (overlap_percentage + epsilon)
+    def update(self, new_datamatrix: pd.DataFrame):
+        """
+        Adds the rows of new_datamatrix not in the network yet and marks their
+        proteins for repartitioning. Returns the set of those proteins.
+        """
+        new_datamatrix = new_datamatrix.sort_values("Start", ascending=False)
+        if self.protein_database is not None:
+            proteins_in_database = self.protein_database["Entry Name"].values.tolist()
+            new_datamatrix = new_datamatrix[
+                new_datamatrix["Protein"].isin(proteins_in_database)
+            ]
+        n_known = pd.MultiIndex.from_arrays(
+            [self.peptides.protein, self.peptides.sequence]
+        ).value_counts()
+        pairs = pd.MultiIndex.from_arrays(
+            [new_datamatrix["Protein"], new_datamatrix["Peptide"]]
+        )
+        row_numbers = new_datamatrix.groupby(["Protein", "Peptide"]).cumcount()
+        is_new = row_numbers.to_numpy() >= n_known.reindex(pairs, fill_value=0)
+        new_datamatrix = new_datamatrix[is_new.to_numpy()]
+        if len(new_datamatrix.index) == 0:
+            print("No new peptides.")
+            return set()
 
-                    length_ratio = get_length_ratio(peptide_from, peptide_to)
+        first_id = int(self.peptides.id.max()) + 1 if len(self.peptides) else 0
+        columns = self._read_peptides(new_datamatrix, first_id=first_id)
+        row_ids = np.concatenate([np.sort(self.peptides.id), columns["id"]])
+        n_previous = {
+            protein: rows.stop - rows.start
+            for protein, rows in self.peptides.protein_slices.items()
+        }
+        self.peptides = PeptideTable(
+            np.concatenate([self.peptides.id, columns["id"]]),
+            np.concatenate([self.peptides.sequence, columns["sequence"]]),
+            np.concatenate([self.peptides.protein, columns["protein"]]),
+            np.concatenate([self.peptides.start, columns["start"]]),
+        )
+        self.datamatrix = pd.concat([self.datamatrix, new_datamatrix])
+        self.proteins = list(set(self.peptides.protein))
 
-                    center_distance = get_center_distance(peptide_from, peptide_to)
+        dirty = set(columns["protein"])
+        if hasattr(self, "protein_networks"):
+            order = self.datamatrix.reset_index(drop=True).sort_values(
+                "Start", ascending=False
+            ).index
+            row_ranks = np.empty(len(order), dtype=np.int64)
+            row_ranks[order] = np.arange(len(order))
+            for protein in dirty:
+                peptides = self.peptides.get_protein(protein)
+                if protein not in self.protein_networks:
+                    self.protein_networks[protein] = (
+                        ig.Graph() if self.backend == "igraph" else nx.Graph()
+                    )
+                insert_peptides(
+                    self.protein_networks[protein],
+                    peptides,
+                    n_previous.get(protein, 0),
+                    row_ranks[np.searchsorted(row_ids, peptides.id)],
+                    self.distance_cutoff,
+                )
+                self._igraphs.pop(protein, None)
+            self._layouts = {
+                key: layout
+                for key, layout in self._layouts.items()
+                if key[0] not in dirty
+            }
+        for key in self.partitions:
+            self.dirty_proteins.setdefault(key, set()).update(dirty)
+        print(f"Added {len(new_datamatrix.index)} peptides to {len(dirty)} proteins.")
+        return dirty
 
-                    d = length_ratio + overlap_distance + center_distance
+    def _update_partitions(self, key, n_jobs=1, executor="process"):
+        """
+        Repartitions the dirty proteins of a cached partition from their
+        previous partition
+        """
+        dirty = self.dirty_proteins.pop(key, set())
+        proteins = [
+            protein for protein in self._get_clustered_proteins() if protein in dirty
+        ]
+        jobs = []
+        for protein in proteins:
+            initial_membership = None
+            if protein in self.partitions[key]:
+                membership = self.partitions[key][protein][1]
+                n_new = self._get_igraph(protein).vcount() - len(membership)
+                initial_membership = membership + list(
+                    range(max(membership) + 1, max(membership) + 1 + n_new)
+                )
+            jobs.append((self._get_igraph(protein), key[0], key[1], initial_membership))
+        partitions = map_largest_first(
+            find_protein_partition,
+            jobs,
+            sizes=[self._get_igraph(protein).vcount() for protein in proteins],
+            n_jobs=n_jobs,
+            executor=executor,
+        )
+        self.partitions[key].update(zip(proteins, partitions))
 
-                    if d <= distance_cutoff:
-                        d = d + epsilon
-                        G.add_edge(
-                            peptide_from.id,
-                            peptide_to.id,
-                            distance=d,
-                            distance_inv=1 / d,
-                        )
-            protein_networks[protein] = G
-        self.protein_networks = protein_networks
+    def save(self, path: str):
+        """
+        Saves the peptides, the edges of each protein network, the cached
+        partitions and their dirty proteins as arrays in an uncompressed .npz
+        file
+        """
+        arrays = {
+            "backend": np.array(self.backend),
+            "map_occurrences": np.array(self.map_occurrences),
+            "peptide_id": self.peptides.id,
+            "peptide_sequence": self.peptides.sequence.astype(str),
+            "peptide_protein": self.peptides.protein.astype(str),
+            "peptide_start": self.peptides.start,
+        }
+        if hasattr(self, "peptide_occurrences"):
+            arrays["occurrence_peptide"] = self.peptide_occurrences[
+                "Peptide"
+            ].to_numpy(dtype=str)
+            arrays["occurrence_protein"] = self.peptide_occurrences[
+                "Protein"
+            ].to_numpy(dtype=str)
+            arrays["occurrence_start"] = self.peptide_occurrences["Start"].to_numpy()
+            arrays["unmatched_peptides"] = self.unmatched_peptides.astype(str)
+        if hasattr(self, "protein_networks"):
+            edges = [
+                get_edge_arrays(G, self.peptides.get_protein(protein).id)
+                for protein, G in self.protein_networks.items()
+            ]
+            arrays["distance_cutoff"] = np.array(self.distance_cutoff)
+            arrays["network_proteins"] = np.array(
+                list(self.protein_networks), dtype=str
+            )
+            arrays["edge_offsets"] = get_offsets([edge[0] for edge in edges])
+            arrays["edges_from"] = concatenate([edge[0] for edge in edges], np.int64)
+            arrays["edges_to"] = concatenate([edge[1] for edge in edges], np.int64)
+            arrays["distances"] = concatenate([edge[2] for edge in edges], float)
 
-        return protein_networks
+        keys = list(self.partitions)
+        arrays["partition_keys"] = np.array(
+            [json.dumps(key) for key in keys], dtype=str
+        )
+        for k, key in enumerate(keys):
+            proteins = list(self.partitions[key])
+            memberships = [self.partitions[key][protein][1] for protein in proteins]
+            arrays[f"partition_{k}_proteins"] = np.array(proteins, dtype=str)
+            arrays[f"partition_{k}_offsets"] = get_offsets(memberships)
+            arrays[f"partition_{k}_membership"] = concatenate(memberships, np.int64)
+            arrays[f"partition_{k}_dirty"] = np.array(
+                sorted(self.dirty_proteins.get(key, ())), dtype=str
+            )
+        if self.clusters_key is not None:
+            arrays["clusters_key"] = np.array(json.dumps(self.clusters_key))
+        np.savez(get_npz_path(path), **arrays)
+
+    @classmethod
+    def load(cls, path: str, protein_database: pd.DataFrame = None):
+        """
+        Loads a PeptideNetwork saved with save. The protein database is not
+        saved, pass it again to plot protein sequences. The datamatrix is
+        restored as the Protein, Peptide and Start of each peptide.
+        """
+        with np.load(get_npz_path(path), allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
 
-    def get_clusters(self, resolution: float, random_seed: int = 42):
+        network = cls.__new__(cls)
+        network.backend = str(arrays["backend"])
+        network.map_occurrences = bool(arrays["map_occurrences"])
+        network.protein_database = protein_database
+        network.protein_index = get_protein_index(protein_database)
+        network.peptides = PeptideTable(
+            arrays["peptide_id"],
+            arrays["peptide_sequence"].astype(object),
+            arrays["peptide_protein"].astype(object),
+            arrays["peptide_start"],
+        )
+        if "occurrence_peptide" in arrays:
+            network.peptide_occurrences = pd.DataFrame(
+                {
+                    "Peptide": arrays["occurrence_peptide"].astype(object),
+                    "Protein": arrays["occurrence_protein"].astype(object),
+                    "Start": arrays["occurrence_start"],
+                }
+            )
+            network.unmatched_peptides = arrays["unmatched_peptides"].astype(object)
+        network.proteins = list(set(network.peptides.protein))
+        order = np.argsort(network.peptides.id)
+        network.datamatrix = pd.DataFrame(
+            {
+                "Protein": network.peptides.protein[order],
+                "Peptide": network.peptides.sequence[order],
+                "Start": network.peptides.start[order],
+            }
+        )
+
+        if "network_proteins" in arrays:
+            network.distance_cutoff = arrays["distance_cutoff"].item()
+            offsets = arrays["edge_offsets"]
+            network.protein_networks = {}
+            for i, protein in enumerate(arrays["network_proteins"].tolist()):
+                edges = slice(offsets[i], offsets[i + 1])
+                network.protein_networks[protein] = get_protein_graph(
+                    network.peptides.get_protein(protein),
+                    arrays["edges_from"][edges],
+                    arrays["edges_to"][edges],
+                    arrays["distances"][edges],
+                    backend=network.backend,
+                )
+
+        network.partitions = {}
+        network.dirty_proteins = {}
+        for k, key in enumerate(arrays["partition_keys"].tolist()):
+            key = to_key(json.loads(key))
+            offsets = arrays[f"partition_{k}_offsets"]
+            membership = arrays[f"partition_{k}_membership"]
+            network.partitions[key] = {
+                protein: (
+                    network.peptides.get_protein(protein).id[
+                        : offsets[i + 1] - offsets[i]
+                    ].tolist(),
+                    membership[offsets[i] : offsets[i + 1]].tolist(),
+                )
+                for i, protein in enumerate(arrays[f"partition_{k}_proteins"].tolist())
+            }
+            if len(arrays[f"partition_{k}_dirty"]):
+                network.dirty_proteins[key] = set(
+                    arrays[f"partition_{k}_dirty"].tolist()
+                )
+        network.clusters_key = None
+        if "clusters_key" in arrays:
+            network.clusters_key = to_key(json.loads(str(arrays["clusters_key"])))
+            network.clusters = network._get_partition_clusters(network.clusters_key)
+        network._igraphs = {}
+        network._layouts = {}
+        return network
+
+    def _get_clustered_proteins(self):
+        return [
+            protein
+            for protein, G in self.protein_networks.items()
+            if get_graph_size(G)[1] > 0
+        ]
+
+    def _get_igraph(self, protein):
+        if protein not in self._igraphs:
+            self._igraphs[protein] = to_igraph(self.protein_networks[protein])
+        return self._igraphs[protein]
+
+    def _get_partition_clusters(self, key):
         peptide_clusters = []
-        for protein, G in zip(
-            self.protein_networks.keys(), self.protein_networks.values()
-        ):
-            if len(G.edges()) == 0:
-                continue
-            H = ig.Graph.from_networkx(G)
-            partition = leidenalg.find_partition(
-                H,
-                leidenalg.RBConfigurationVertexPartition,
-                n_iterations=4,
-                weights="distance_inv",
-                seed=random_seed,
-                resolution_parameter=resolution,
+        for protein, (peptide_ids, membership) in self.partitions[key].items():
+            peptide_clusters.extend(
+                self._get_protein_clusters(protein, peptide_ids, membership)
             )
-            clusters = {}
-            for i, cluster in enumerate(partition):
-                for node in cluster:
-                    peptide_id = H.vs[node]["_nx_name"]
-                    clusters[peptide_id] = i
-
-            cluster_dict = {}
-            for cluster_index, peptide_index in zip(clusters.values(), clusters.keys()):
-                cluster_name = f"{protein}_{cluster_index}"
-                if cluster_name not in cluster_dict.keys():
-                    cluster_dict[cluster_name] = []
-                peptide = self._get_peptide(peptide_index)
-                cluster_dict[cluster_name].append(peptide)
-
-            for cluster_id in cluster_dict.keys():
-                peptide_clusters.append(
-                    PeptideCluster(
-                        cluster_id=cluster_id,
-                        peptides=cluster_dict[cluster_id],
-                        protein=protein,
-                    )
+        return PeptideClusters(peptide_clusters)
+
+    def _get_protein_clusters(self, protein, peptide_ids, membership):
+        cluster_dict = {}
+        for node in sorted(range(len(membership)), key=membership.__getitem__):
+            cluster_name = f"{protein}_{membership[node]}"
+            if cluster_name not in cluster_dict.keys():
+                cluster_dict[cluster_name] = []
+            cluster_dict[cluster_name].append(self._get_peptide(peptide_ids[node]))
+
+        return [
+            PeptideCluster(
+                cluster_id=cluster_id,
+                peptides=peptides,
+                protein=protein,
+            )
+            for cluster_id, peptides in cluster_dict.items()
+        ]
+
+    def _get_protein_partition(self, protein, resolution=None, random_seed=42):
+        if resolution is not None:
+            key = (resolution, random_seed)
+        elif self.clusters_key is not None:
+            key = self.clusters_key
+        else:
+            key = (0.8, random_seed)
+        if key in self.partitions:
+            self._update_partitions(key)
+        if key in self.partitions and protein in self.partitions[key]:
+            return self.partitions[key][protein]
+        return find_protein_partition(self._get_igraph(protein), key[0], key[1])
+
+    def _get_layout(self, protein, layout="spring", random_seed=42):
+        if (protein, layout) not in self._layouts:
+            if layout == "spring":
+                graph = self.get_networkx(protein)
+                positions = nx.spring_layout(
+                    graph,
+                    weight="distance_inv",
+                    k=1.5 / np.sqrt(graph.number_of_nodes()),
+                    seed=random_seed,
                 )
-        clusters = PeptideClusters(peptide_clusters)
-        self.clusters = clusters
-        return clusters
+            elif layout == "igraph":
+                H = self._get_igraph(protein)
+                coordinates = H.layout_fruchterman_reingold(weights="distance_inv")
+                positions = dict(zip(H.vs["id"], np.array(coordinates.coords)))
+            else:
+                raise ValueError(f"layout must be 'spring' or 'igraph', got {layout}")
+            self._layouts[(protein, layout)] = positions
+        return self._layouts[(protein, layout)]
+
+    def get_networkx(self, protein):
+        """
+        Returns the network of a protein as a networkx graph, whichever backend
+        it was built with.
+        """
+        return to_networkx(self.protein_networks[protein])
 
     def _get_peptide(self, id):
-        for peptide in self.peptides:
-            if peptide.id == id:
-                return peptide
-        return None
+        return self.peptides.get(id)
 
     def _get_protein_sequence(self, protein):
-        if protein in self.protein_database["Entry Name"].values.tolist():
-            protein_seq = self.protein_database[
-                self.protein_database["Entry Name"] == protein
-            ]["Sequence"].values[0]
-            return protein_seq
+        if protein in self.protein_index:
+            return self.protein_index.get_sequence(protein)
         return "Not in database"
 
-    def _get_peptide_start(self, peptide, protein):
-        if self.protein_database is not None:
-            if protein in self.protein_database["Entry Name"].values.tolist():
-                protein_seq = self.protein_database[
-                    self.protein_database["Entry Name"] == protein
-                ]["Sequence"].values[0]
-                start = protein_seq.find(peptide)
-                return start
-            print(f"Protein {protein} not in database.")
-        else:
-            return self.datamatrix[self.datamatrix["Peptide"] == peptide][
-                "Start"
-            ].values[0]
-        return "Not in database"
+    def plot_protein(
+        self,
+        protein,
+        save_str=None,
+        figsize=(8, 4),
+        resolution: float = None,
+        random_seed: int = 42,
+        layout: str = "spring",
+        preview: bool = False,
+        max_edges: int = None,
+        dpi: int = None,
+    ):
+        """
+        Plots the network of a protein colored by start position and cluster.
+        The clusters are taken from the partition cache: the given resolution,
+        else the last get_clusters call, else a resolution of 0.8. layout is
+        "spring" (networkx) or "igraph" (igraph's Fruchterman-Reingold, faster
+        on big graphs); layouts are cached per protein.
 
-    def plot_protein(self, protein, save_str=None, figsize=(8,4)):
+        preview=True draws each panel as one rasterized edge collection and
+        one scatter, with at most max_edges randomly sampled edges, and saves
+        at 150 dpi unless dpi is given (1200 otherwise).
+        """
         plt.clf()
         fig, axs = plt.subplots(1, 2, figsize=figsize)
-        graph = self.protein_networks[protein]
-        H = ig.Graph.from_networkx(graph)
-        partition = leidenalg.find_partition(
-            H,
-            leidenalg.RBConfigurationVertexPartition,
-            n_iterations=4,
-            weights="distance_inv",
-            resolution_parameter=.8,
-        )
-        clusters = {}
-        for i, cluster in enumerate(partition):
-            for node in cluster:
-                peptide_id = H.vs[node]["_nx_name"]
-                clusters[peptide_id] = i
-        partition=clusters
-        layout = nx.spring_layout(
-            graph, weight="distance_inv", k=1.5 / np.sqrt(graph.number_of_nodes())
+        partition = dict(
+            zip(*self._get_protein_partition(protein, resolution, random_seed))
         )
+        layout = self._get_layout(protein, layout, random_seed)
+        if dpi is None:
+            dpi = 150 if preview else 1200
+        if preview:
+            self._draw_preview(protein, partition, layout, axs, max_edges, random_seed)
+            plt.suptitle(f"{protein} network")
+            sns.despine()
+            plt.tight_layout()
+            if save_str:
+                plt.savefig(save_str, dpi=dpi)
+            return
+
+        graph = self.get_networkx(protein)
 
-        cmap_partition = cm.get_cmap("tab20", max(partition.values()) + 1)
+        cmap_partition = plt.get_cmap("tab20", max(partition.values()) + 1)
 
         n1 = nx.draw_networkx_nodes(
             graph,
             layout,
             partition.keys(),
             node_size=1,
-            node_color=[graph.nodes[n]["start"] for n in graph.nodes()],
+            node_color=[graph.nodes[n]["start"] for n in partition.keys()],
             cmap=plt.cm.Blues,
             alpha=0.8,
             ax=axs[0],
@@ -224,7 +613,45 @@ class PeptideNetwork:
         sns.despine()
         plt.tight_layout()
         if save_str:
-            plt.savefig(save_str, dpi=1200)
+            plt.savefig(save_str, dpi=dpi)
+
+    def _draw_preview(self, protein, partition, layout, axs, max_edges, random_seed):
+        H = self._get_igraph(protein)
+        ids = H.vs["id"]
+        positions = np.array([layout[id] for id in ids])
+        edges = np.array(H.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        if max_edges is not None and len(edges) > max_edges:
+            rng = np.random.default_rng(random_seed)
+            edges = edges[rng.choice(len(edges), max_edges, replace=False)]
+        segments = positions[edges]
+
+        memberships = [partition[id] for id in ids]
+        panels = [
+            (H.vs["start"], plt.cm.Blues, 1, "Start position"),
+            (
+                memberships,
+                plt.get_cmap("tab20", max(memberships) + 1),
+                3,
+                "Designated cluster",
+            ),
+        ]
+        for ax, (colors, cmap, size, label) in zip(axs, panels):
+            ax.add_collection(
+                LineCollection(
+                    segments, colors="k", alpha=0.5, linewidths=0.5, rasterized=True
+                )
+            )
+            nodes = ax.scatter(
+                positions[:, 0],
+                positions[:, 1],
+                c=colors,
+                s=size,
+                cmap=cmap,
+                alpha=0.8,
+                rasterized=True,
+            )
+            plt.colorbar(nodes, ax=ax, label=label)
+            ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
 
 
 def get_overlap_percentage(peptide1, peptide2, divisor="total_length"):
@@ -267,3 +694,388 @@ def get_endpoints_distance(peptide1, peptide2):
     start_dist = np.abs(peptide1.start - peptide2.start)
     end_dist = np.abs(peptide1.end - peptide2.end)
     return start_dist + end_dist
+
+
+def find_protein_partition(G, resolution, random_seed=42, initial_membership=None):
+    """
+    Returns the node names of G and their Leiden cluster memberships. If
+    initial_membership is given, Leiden starts from that partition.
+    """
+    H = to_igraph(G)
+    if initial_membership is None:
+        partition = leidenalg.find_partition(
+            H,
+            leidenalg.RBConfigurationVertexPartition,
+            n_iterations=4,
+            weights="distance_inv",
+            seed=random_seed,
+            resolution_parameter=resolution,
+        )
+    else:
+        partition = leidenalg.RBConfigurationVertexPartition(
+            H,
+            initial_membership=initial_membership,
+            weights="distance_inv",
+            resolution_parameter=resolution,
+        )
+        optimiser = leidenalg.Optimiser()
+        optimiser.set_rng_seed(random_seed)
+        optimiser.optimise_partition(partition, n_iterations=4)
+    return H.vs["id"], partition.membership
+
+
+def build_protein_network(peptides_in_protein, distance_cutoff=4, backend="networkx"):
+    """
+    Builds the network of one protein from its PeptideTable as a networkx
+    graph or, with backend="igraph", directly as an igraph graph with the
+    same attributes.
+    """
+    _, sequence_codes = np.unique(peptides_in_protein.sequence, return_inverse=True)
+    edges_from, edges_to, distances = get_pairwise_distances(
+        peptides_in_protein.start,
+        peptides_in_protein.end,
+        sequence_codes,
+        distance_cutoff=distance_cutoff,
+    )
+    return get_protein_graph(
+        peptides_in_protein, edges_from, edges_to, distances, backend=backend
+    )
+
+
+def insert_peptides(G, peptides_in_protein, n_previous, ranks, distance_cutoff=4):
+    """
+    Adds the peptides after the first n_previous rows to G, with the edges
+    create_network would build given the row order in ranks
+    """
+    reordered_from, reordered_to = [], []
+    for i, j in get_candidate_pairs(
+        peptides_in_protein.start[:n_previous], peptides_in_protein.end[:n_previous]
+    ):
+        reordered = ranks[i] < ranks[j]
+        reordered_from.append(i[reordered])
+        reordered_to.append(j[reordered])
+    reordered_from = concatenate(reordered_from, np.int64)
+    reordered_to = concatenate(reordered_to, np.int64)
+    _, sequence_codes = np.unique(peptides_in_protein.sequence, return_inverse=True)
+    edges_from, edges_to, distances = get_pairwise_distances(
+        peptides_in_protein.start,
+        peptides_in_protein.end,
+        sequence_codes,
+        distance_cutoff=distance_cutoff,
+        new_from=n_previous,
+        ranks=ranks,
+    )
+    new = slice(n_previous, None)
+    ids = peptides_in_protein.id.tolist()
+    sequences = peptides_in_protein.sequence[new].tolist()
+    proteins = peptides_in_protein.protein[new].tolist()
+    starts = peptides_in_protein.start[new].tolist()
+    ends = peptides_in_protein.end[new].tolist()
+
+    if isinstance(G, ig.Graph):
+        reordered_edges = G.get_eids(
+            np.column_stack((reordered_to, reordered_from)).tolist(), error=False
+        )
+        G.delete_edges([edge for edge in reordered_edges if edge != -1])
+        G.add_vertices(
+            len(sequences),
+            attributes={
+                "id": ids[new],
+                "peptide": sequences,
+                "protein": proteins,
+                "start": starts,
+                "end": ends,
+            },
+        )
+        G.add_edges(
+            np.column_stack((edges_to, edges_from)).tolist(),
+            attributes={
+                "distance": distances.tolist(),
+                "distance_inv": (1 / distances).tolist(),
+            },
+        )
+        return G
+
+    G.remove_edges_from(
+        (ids[i], ids[j]) for i, j in zip(reordered_from.tolist(), reordered_to.tolist())
+    )
+    G.add_nodes_from(
+        (id, {"peptide": sequence, "protein": protein, "start": start, "end": end})
+        for id, sequence, protein, start, end in zip(
+            ids[new], sequences, proteins, starts, ends
+        )
+    )
+    G.add_edges_from(
+        (ids[i], ids[j], {"distance": d, "distance_inv": 1 / d})
+        for i, j, d in zip(edges_from.tolist(), edges_to.tolist(), distances.tolist())
+    )
+    return G
+
+
+def get_protein_graph(
+    peptides_in_protein, edges_from, edges_to, distances, backend="networkx"
+):
+    """
+    Creates the graph of one protein from its PeptideTable and edge arrays of
+    row indices (i, j), i > j, sorted by (i, j)
+    """
+    ids = peptides_in_protein.id.tolist()
+    sequences = peptides_in_protein.sequence.tolist()
+    proteins = peptides_in_protein.protein.tolist()
+    starts = peptides_in_protein.start.tolist()
+    ends = peptides_in_protein.end.tolist()
+
+    if backend == "igraph":
+        order = np.lexsort((edges_from, edges_to))
+        distances = distances[order]
+        return ig.Graph(
+            n=len(ids),
+            edges=np.column_stack((edges_to[order], edges_from[order])).tolist(),
+            vertex_attrs={
+                "id": ids,
+                "peptide": sequences,
+                "protein": proteins,
+                "start": starts,
+                "end": ends,
+            },
+            edge_attrs={
+                "distance": distances.tolist(),
+                "distance_inv": (1 / distances).tolist(),
+            },
+        )
+
+    G = nx.Graph()
+    G.add_nodes_from(
+        (id, {"peptide": sequence, "protein": protein, "start": start, "end": end})
+        for id, sequence, protein, start, end in zip(
+            ids, sequences, proteins, starts, ends
+        )
+    )
+    G.add_edges_from(
+        (ids[i], ids[j], {"distance": d, "distance_inv": 1 / d})
+        for i, j, d in zip(edges_from.tolist(), edges_to.tolist(), distances.tolist())
+    )
+    return G
+
+
+def get_edge_arrays(G, ids):
+    """
+    Returns the edges of a networkx or igraph protein network as row indices
+    (i, j), i > j, into ids, sorted by (i, j), and their distances
+    """
+    if isinstance(G, ig.Graph):
+        if G.ecount() == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        pairs = np.array(G.get_edgelist(), dtype=np.int64)
+        distances = np.array(G.es["distance"], dtype=float)
+    else:
+        rows = {id: row for row, id in enumerate(ids)}
+        edges = list(G.edges(data="distance"))
+        pairs = np.array(
+            [(rows[u], rows[v]) for u, v, _ in edges], dtype=np.int64
+        ).reshape(-1, 2)
+        distances = np.array([d for _, _, d in edges], dtype=float)
+    edges_from, edges_to = pairs.max(axis=1), pairs.min(axis=1)
+    order = np.lexsort((edges_to, edges_from))
+    return edges_from[order], edges_to[order], distances[order]
+
+
+def to_key(value):
+    """
+    Returns a partition key read from JSON, with its lists as tuples
+    """
+    if isinstance(value, list):
+        return tuple(to_key(item) for item in value)
+    return value
+
+
+def get_offsets(arrays):
+    """
+    Returns the boundaries of arrays when concatenated
+    """
+    return np.cumsum([0] + [len(array) for array in arrays], dtype=np.int64)
+
+
+def concatenate(arrays, dtype):
+    return np.concatenate([np.empty(0, dtype=dtype)] + list(arrays)).astype(dtype)
+
+
+def to_igraph(G):
+    """
+    Converts a networkx protein network to igraph. The peptide ids are stored
+    in the "id" vertex attribute, as in networks built with the igraph backend.
+    """
+    if isinstance(G, ig.Graph):
+        return G
+    H = ig.Graph.from_networkx(G)
+    H.vs["id"] = H.vs["_nx_name"]
+    return H
+
+
+def to_networkx(G):
+    if isinstance(G, nx.Graph):
+        return G
+    graph = nx.Graph()
+    for vertex in G.vs:
+        graph.add_node(
+            vertex["id"],
+            peptide=vertex["peptide"],
+            protein=vertex["protein"],
+            start=vertex["start"],
+            end=vertex["end"],
+        )
+    edges = sorted((max(edge.tuple), min(edge.tuple), edge.index) for edge in G.es)
+    ids = G.vs["id"]
+    graph.add_edges_from(
+        (
+            ids[i],
+            ids[j],
+            {
+                "distance": G.es[index]["distance"],
+                "distance_inv": G.es[index]["distance_inv"],
+            },
+        )
+        for i, j, index in edges
+    )
+    return graph
+
+
+def get_graph_size(G):
+    """
+    Returns the number of nodes and edges of a networkx or igraph graph
+    """
+    if isinstance(G, ig.Graph):
+        return G.vcount(), G.ecount()
+    return G.number_of_nodes(), G.number_of_edges()
+
+
+def get_candidate_pairs(starts, ends, block_size=1_000_000):
+    """
+    Yields blocks of index pairs (i, j), i > j, of intervals that overlap.
+    Intervals are sorted by start and each one is paired with the intervals
+    starting before it ends, so non-overlapping pairs are never generated.
+    """
+    order = np.argsort(starts, kind="stable")
+    sorted_starts = starts[order]
+    last = np.searchsorted(sorted_starts, ends[order], side="left")
+    n_partners = np.maximum(last - np.arange(len(order)) - 1, 0)
+    cumulative = np.cumsum(n_partners)
+
+    block_start = 0
+    while block_start < len(order):
+        offset = cumulative[block_start] - n_partners[block_start]
+        block_end = max(
+            np.searchsorted(cumulative, offset + block_size, side="right"),
+            block_start + 1,
+        )
+        counts = n_partners[block_start:block_end]
+        positions = np.repeat(np.arange(block_start, block_end), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        partners = positions + 1 + np.arange(len(positions)) - first
+        a, b = order[positions], order[partners]
+        yield np.maximum(a, b), np.minimum(a, b)
+        block_start = block_end
+
+
+def get_pairwise_distances(
+    starts,
+    ends,
+    sequence_codes=None,
+    distance_cutoff=4,
+    block_size=1_000_000,
+    new_from=0,
+    ranks=None,
+):
+    """
+    Vectorized version of the edge criterion in create_network. Returns the
+    pairs (i, j), i > j, with a distance below the cutoff and their distances,
+    sorted as in a double loop over the peptides. With new_from, only pairs
+    with i >= new_from (i.e. involving a peptide from that row on) are returned,
+    and with ranks, pairs are ordered by rank instead of by row.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    epsilon = 1e-8
+    edges_from, edges_to, distances = [], [], []
+    for i, j in get_candidate_pairs(starts, ends, block_size=block_size):
+        if new_from:
+            new = i >= new_from
+            if ranks is not None:
+                new |= ranks[i] < ranks[j]
+            i, j = i[new], j[new]
+        if sequence_codes is not None:
+            different = sequence_codes[i] != sequence_codes[j]
+            i, j = i[different], j[different]
+        first, second = i, j
+        if ranks is not None:
+            later = ranks[i] > ranks[j]
+            first, second = np.where(later, i, j), np.where(later, j, i)
+        overlap_percentage = get_overlap_percentages(
+            starts[first], ends[first], starts[second], ends[second]
+        )
+        overlapping = overlap_percentage != 0
+        i, j = i[overlapping], j[overlapping]
+        overlap_distance = 1 / (overlap_percentage[overlapping] + epsilon)
+        length_ratio = get_length_ratios(starts[i], ends[i], starts[j], ends[j])
+        center_distance = get_center_distances(starts[i], ends[i], starts[j], ends[j])
+
+        d = length_ratio + overlap_distance + center_distance
+        keep = d <= distance_cutoff
+        edges_from.append(i[keep])
+        edges_to.append(j[keep])
+        distances.append(d[keep] + epsilon)
+
+    if len(distances) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    edges_from = np.concatenate(edges_from)
+    edges_to = np.concatenate(edges_to)
+    distances = np.concatenate(distances)
+    order = np.lexsort((edges_to, edges_from))
+    return edges_from[order], edges_to[order], distances[order]
+
+
+def get_overlap_percentages(starts1, ends1, starts2, ends2, divisor="total_length"):
+    """
+    Vectorized get_overlap_percentage
+    """
+    swap = starts1 > starts2
+    starts1, starts2 = (
+        np.where(swap, starts2, starts1),
+        np.where(swap, starts1, starts2),
+    )
+    ends1, ends2 = np.where(swap, ends2, ends1), np.where(swap, ends1, ends2)
+    lengths1 = ends1 - starts1
+    lengths2 = ends2 - starts2
+
+    overlap = ends1 - starts2
+    total_length = lengths1 + lengths2 - overlap
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if divisor == "total_length":
+            percentage = overlap / total_length
+        elif divisor == "longest_peptide":
+            percentage = overlap / np.maximum(lengths1, lengths2)
+        elif divisor == "shortest_peptide":
+            percentage = overlap / np.minimum(lengths1, lengths2)
+        elif divisor == None:
+            percentage = (total_length - overlap).astype(float)
+    percentage = np.where((starts2 >= starts1) & (ends2 <= ends1), 1, percentage)
+    return np.where(ends1 < starts2, 0, percentage)
+
+
+def get_center_distances(starts1, ends1, starts2, ends2):
+    centers1 = starts1 + (ends1 - starts1) / 2
+    centers2 = starts2 + (ends2 - starts2) / 2
+    return np.abs(centers1 - centers2)
+
+
+def get_length_ratios(starts1, ends1, starts2, ends2):
+    lengths1 = ends1 - starts1
+    lengths2 = ends2 - starts2
+    return np.maximum(lengths1 / lengths2, lengths2 / lengths1)
+
+
+def get_endpoints_distances(starts1, ends1, starts2, ends2):
+    """
+    Vectorized get_endpoints_distance
+    """
+    return np.abs(starts1 - starts2) + np.abs(ends1 - ends2)
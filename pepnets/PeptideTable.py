@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+
+from pepnets.Peptide import Peptide
+
+
+class PeptideTable:
+    """
+    Struct-of-arrays storage for peptides. Rows are grouped by protein, so
+    each protein is a contiguous slice, and peptides are looked up by id in
+    O(1) through an index built on first use. Iterating or calling get returns
+    PeptideViews.
+    """
+
+    def __init__(self, id, sequence, protein, start):
+        codes, _ = pd.factorize(np.asarray(protein, dtype=object))
+        order = np.argsort(codes, kind="stable")
+        self.id = np.asarray(id, dtype=np.int64)[order]
+        self.sequence = np.asarray(sequence, dtype=object)[order]
+        self.protein = np.asarray(protein, dtype=object)[order]
+        self.start = np.asarray(start, dtype=np.int64)[order]
+        self.length = np.fromiter(
+            map(len, self.sequence), dtype=np.int64, count=len(self.sequence)
+        )
+        self.end = self.start + self.length
+        self.center = self.start + self.length / 2
+        self._build_index()
+
+    @classmethod
+    def _from_arrays(cls, id, sequence, protein, start, length, end, center):
+        table = cls.__new__(cls)
+        table.id = id
+        table.sequence = sequence
+        table.protein = protein
+        table.start = start
+        table.length = length
+        table.end = end
+        table.center = center
+        table._build_index()
+        return table
+
+    def _build_index(self):
+        n = len(self.id)
+        boundaries = np.flatnonzero(self.protein[1:] != self.protein[:-1]) + 1
+        starts = np.concatenate([[0], boundaries]) if n else np.array([], dtype=int)
+        ends = np.concatenate([boundaries, [n]]) if n else np.array([], dtype=int)
+        self.protein_slices = {
+            self.protein[start]: slice(start, end)
+            for start, end in zip(starts.tolist(), ends.tolist())
+        }
+        self._index = None
+
+    @property
+    def _rows(self):
+        """
+        Row of each id, -1 for ids not in the table. Built lazily, so the
+        per-protein tables of get_protein do not allocate one each.
+        """
+        if self._index is None:
+            n = len(self.id)
+            self._index = np.full(self.id.max() + 1 if n else 0, -1, dtype=np.int64)
+            self._index[self.id] = np.arange(n)
+        return self._index
+
+    @property
+    def proteins(self):
+        return list(self.protein_slices.keys())
+
+    def get(self, id):
+        if id < 0 or id >= len(self._rows) or self._rows[id] == -1:
+            return None
+        return PeptideView(self, self._rows[id].item())
+
+    def get_protein(self, protein):
+        """
+        Returns the peptides of one protein as a PeptideTable of array views
+        """
+        rows = self.protein_slices[protein]
+        return self._from_arrays(
+            self.id[rows],
+            self.sequence[rows],
+            self.protein[rows],
+            self.start[rows],
+            self.length[rows],
+            self.end[rows],
+            self.center[rows],
+        )
+
+    def __len__(self):
+        return len(self.id)
+
+    def __iter__(self):
+        for row in self._rows[self._rows != -1].tolist():
+            yield PeptideView(self, row)
+
+    def __repr__(self) -> str:
+        return f"PeptideTable: {len(self)} peptides, {len(self.protein_slices)} proteins"
+
+
+class PeptideView:
+    """
+    Peptide-like view of one row in a PeptideTable
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: PeptideTable, row: int):
+        self.table = table
+        self.row = row
+
+    @property
+    def id(self):
+        return self.table.id[self.row].item()
+
+    @property
+    def sequence(self):
+        return self.table.sequence[self.row]
+
+    @property
+    def protein(self):
+        return self.table.protein[self.row]
+
+    @property
+    def start(self):
+        return self.table.start[self.row].item()
+
+    @property
+    def end(self):
+        return self.table.end[self.row].item()
+
+    @property
+    def length(self):
+        return self.table.length[self.row].item()
+
+    @property
+    def center(self):
+        return self.table.center[self.row].item()
+
+    def __reduce__(self):
+        return Peptide, (self.sequence, self.start, self.protein, self.id)
+
+    def __repr__(self) -> str:
+        return f"{self.sequence} ({self.protein}), start: {self.start}, end: {self.end}"
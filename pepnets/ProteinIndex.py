@@ -0,0 +1,55 @@
+import pandas as pd
+
+
+class ProteinIndex:
+    """
+    Maps Entry Name to sequence for a protein database. Built once, so that
+    sequence lookups don't have to filter the database DataFrame.
+    """
+
+    def __init__(self, database: pd.DataFrame):
+        self.sequences = {}
+        self.positions = {}
+        for position, (protein, sequence) in enumerate(
+            zip(database["Entry Name"].values, database["Sequence"].values)
+        ):
+            if protein not in self.sequences:
+                self.sequences[protein] = sequence
+                self.positions[protein] = position
+
+    def get_sequence(self, protein):
+        return self.sequences[protein]
+
+    def get_first_sequence(self, proteins: list):
+        """
+        Returns the sequence of whichever of proteins comes first in the database
+        """
+        in_index = [protein for protein in proteins if protein in self.sequences]
+        if len(in_index) == 0:
+            raise KeyError(f"None of {proteins} in database")
+        return self.sequences[min(in_index, key=self.positions.get)]
+
+    def get_aa(self, protein, index):
+        sequence = self.sequences[protein]
+        try:
+            return sequence[index]
+        except IndexError:
+            return None
+
+    def __contains__(self, protein):
+        return protein in self.sequences
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __repr__(self) -> str:
+        return f"ProteinIndex with {len(self)} proteins"
+
+
+def get_protein_index(database):
+    """
+    Returns database as a ProteinIndex, building one if it is a DataFrame
+    """
+    if database is None or isinstance(database, ProteinIndex):
+        return database
+    return ProteinIndex(database)
@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class SampleStore:
+    """
+    On-disk datamatrix: the sample intensities are a memory-mapped .npy file in
+    column-major order, so each sample is contiguous on disk, and the peptide
+    annotations are a small metadata frame. Missing values (NaN or 0) are
+    stored as NaN. Can be passed to FeatureMatrix, PeptiGram and LogoPlot in
+    place of a DataFrame.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.intensities = np.load(os.path.join(path, "intensities.npy"), mmap_mode="r")
+        self.metadata = pd.read_pickle(os.path.join(path, "metadata.pkl"))
+        with open(os.path.join(path, "samples.json")) as f:
+            self.samples = json.load(f)
+        self.rows = None
+        self._positions = {sample: i for i, sample in enumerate(self.samples)}
+
+    @classmethod
+    def from_dataframe(
+        cls,
+        datamatrix: pd.DataFrame,
+        path: str,
+        samples: list = None,
+        dtype=np.float64,
+    ):
+        """
+        Writes datamatrix to path, one sample column at a time, and opens it.
+        samples defaults to the columns containing "Sample"; all other columns
+        go in the metadata frame.
+        """
+        if samples is None:
+            samples = [col for col in datamatrix.columns if "Sample" in col]
+        os.makedirs(path, exist_ok=True)
+        intensities = np.lib.format.open_memmap(
+            os.path.join(path, "intensities.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(len(datamatrix.index), len(samples)),
+            fortran_order=True,
+        )
+        for j, sample in enumerate(samples):
+            values = datamatrix[sample].to_numpy(dtype=dtype)
+            intensities[:, j] = np.where(values == 0, np.nan, values)
+        intensities.flush()
+        del intensities
+        metadata = datamatrix[[col for col in datamatrix.columns if col not in samples]]
+        metadata.reset_index(drop=True).to_pickle(os.path.join(path, "metadata.pkl"))
+        with open(os.path.join(path, "samples.json"), "w") as f:
+            json.dump(list(samples), f)
+        return cls(path)
+
+    @property
+    def columns(self):
+        return pd.Index(list(self.metadata.columns) + self.samples)
+
+    def subset(self, rows, metadata: pd.DataFrame):
+        """
+        Returns a store over the given rows that shares the memory map, with
+        metadata as its annotations. Reading a subset of rows that is not one
+        contiguous run copies them into memory.
+        """
+        store = SampleStore.__new__(SampleStore)
+        store.path = self.path
+        store.intensities = self.intensities
+        store.samples = self.samples
+        store._positions = self._positions
+        store.rows = np.asarray(rows) if self.rows is None else self.rows[rows]
+        store.metadata = metadata
+        return store
+
+    def get_samples(self, samples: list = None):
+        """
+        Returns the intensities of samples as an array. Consecutive samples of
+        a store over consecutive rows are a view of the memory map; otherwise
+        only the requested columns and rows are read into a copy.
+        """
+        if samples is None:
+            samples = self.samples
+        columns = np.array([self._positions[sample] for sample in samples], dtype=int)
+        if len(columns) and np.all(np.diff(columns) == 1):
+            intensities = self.intensities[:, columns[0] : columns[-1] + 1]
+        else:
+            intensities = self.intensities[:, columns]
+        if self.rows is not None:
+            if len(self.rows) and np.all(np.diff(self.rows) == 1):
+                intensities = intensities[self.rows[0] : self.rows[-1] + 1]
+            else:
+                intensities = intensities[self.rows]
+        return intensities
+
+    def to_dataframe(self, samples: list = None):
+        """
+        Returns the metadata and the intensities of samples as one DataFrame
+        """
+        if samples is None:
+            samples = self.samples
+        samples = list(samples)
+        intensities = pd.DataFrame(
+            np.asarray(self.get_samples(samples)),
+            index=self.metadata.index,
+            columns=samples,
+        )
+        return pd.concat([self.metadata, intensities], axis=1)
+
+    def __len__(self):
+        return len(self.metadata.index)
+
+    def __repr__(self) -> str:
+        return f"SampleStore: {len(self)} peptides, {len(self.samples)} samples"
+
+
+def get_datamatrix(datamatrix, samples: list = None):
+    """
+    Returns datamatrix as a DataFrame, reading only samples if it is a SampleStore
+    """
+    if isinstance(datamatrix, SampleStore):
+        return datamatrix.to_dataframe(samples)
+    return datamatrix
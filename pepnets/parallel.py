@@ -0,0 +1,38 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def map_largest_first(
+    function,
+    jobs,
+    sizes,
+    n_jobs=1,
+    executor="process",
+    initializer=None,
+    initargs=(),
+):
+    """
+    Calls function(*job) for every job and returns the results in job order.
+    With n_jobs > 1 (or -1 for all cores) the jobs run on a process or thread
+    pool, biggest job first so that one large protein does not finish last.
+    initializer(*initargs) is called once per worker (or once in this process
+    with n_jobs=1), to send data shared by all jobs only once.
+    """
+    if n_jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(*job) for job in jobs]
+    if executor == "process":
+        pool = ProcessPoolExecutor
+    elif executor == "thread":
+        pool = ThreadPoolExecutor
+    else:
+        raise ValueError(f"executor must be 'process' or 'thread', got {executor}")
+
+    max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+    largest_first = sorted(range(len(jobs)), key=lambda i: sizes[i], reverse=True)
+    with pool(
+        max_workers=max_workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        futures = {i: executor.submit(function, *jobs[i]) for i in largest_first}
+        return [futures[i].result() for i in range(len(jobs))]
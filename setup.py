@@ -6,7 +6,8 @@ requirements=[
     "pandas",
     "matplotlib",
     "numpy",
-    "seaborn"
+    "scipy",
+    "seaborn",
     "igraph",
     "logomaker"
 ]
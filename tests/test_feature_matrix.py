@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pepnets.FeatureMatrix import FeatureMatrix
+from pepnets.Peptide import Peptide
+from pepnets.PeptideCluster import PeptideCluster
+from pepnets.PeptideClusters import PeptideClusters
+
+
+def make_data(random_seed=0, n_clusters=12, n_samples=5):
+    rng = np.random.default_rng(random_seed)
+    clusters, rows = [], []
+    for k in range(n_clusters):
+        protein = f"P{k % 3}_TEST"
+        peptides = [
+            Peptide(f"PEPTIDE{k}X{i}", 10 * k + i, protein, len(rows) + i)
+            for i in range(int(rng.integers(1, 8)))
+        ]
+        clusters.append(PeptideCluster(f"{protein}_{k}", peptides, protein))
+        for peptide in peptides:
+            intensities = rng.lognormal(10, 2, n_samples)
+            intensities[rng.random(n_samples) < 0.4] = 0
+            rows.append(
+                {
+                    "Protein": protein,
+                    "Peptide": peptide.sequence,
+                    "Start": peptide.start,
+                    **{f"Sample {j}": value for j, value in enumerate(intensities)},
+                }
+            )
+    rows.append({"Protein": "P9_TEST", "Peptide": "UNASSIGNED", "Start": 0})
+    return pd.DataFrame(rows), PeptideClusters(clusters)
+
+
+def get_brute_force_topn(datamatrix, clusters, top_n, summarization_method):
+    samples = [col for col in datamatrix.columns if "Sample" in col]
+    summarize = {"sum": np.sum, "mean": np.mean, "median": np.median}
+    quantifications = {}
+    for cluster in clusters:
+        sequences = [peptide.sequence for peptide in cluster.peptides]
+        rows = datamatrix[datamatrix["Peptide"].isin(sequences)]
+        quantifications[cluster.id] = [
+            summarize[summarization_method](
+                sorted(np.nan_to_num(rows[sample].to_numpy()), reverse=True)[:top_n]
+            )
+            for sample in samples
+        ]
+    return pd.DataFrame.from_dict(quantifications, orient="index", columns=samples)
+
+
+@pytest.mark.parametrize("summarization_method", ["sum", "mean", "median"])
+@pytest.mark.parametrize("top_n", [1, 3])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_topn_matches_brute_force(summarization_method, top_n, sparse):
+    datamatrix, clusters = make_data()
+    topn = FeatureMatrix(datamatrix, clusters, sparse=sparse).get_topn(
+        top_n, summarization_method
+    )
+    expected = get_brute_force_topn(datamatrix, clusters, top_n, summarization_method)
+    np.testing.assert_allclose(
+        topn.loc[expected.index, expected.columns].to_numpy(),
+        expected.to_numpy(),
+        rtol=1e-12,
+    )
+    assert sorted(topn.index) == sorted(expected.index)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from pepnets.Peptide import Peptide
+from pepnets.PeptideNetwork import (
+    get_center_distance,
+    get_length_ratio,
+    get_overlap_percentage,
+    get_pairwise_distances,
+)
+
+
+def get_peptides(random_seed=0, n_peptides=150):
+    """
+    Peptides of one protein around a few hotspots, so many share a start
+    """
+    rng = np.random.default_rng(random_seed)
+    sequence = "".join(rng.choice(list("ACDEFGHIKLMNPQRSTVWY"), 120))
+    hotspots = rng.integers(0, 90, size=4)
+    peptides = []
+    for id in range(n_peptides):
+        start = int(rng.choice(hotspots) + rng.integers(0, 4))
+        length = int(rng.integers(4, 25))
+        peptides.append(Peptide(sequence[start : start + length], start, "P", id))
+    return sorted(peptides, key=lambda peptide: -peptide.start)
+
+
+def get_loop_edges(peptides, distance_cutoff):
+    """
+    The edges of the double loop over the peptides in create_network
+    """
+    epsilon = 1e-8
+    edges = []
+    for i, peptide_from in enumerate(peptides):
+        for j in range(i + 1):
+            peptide_to = peptides[j]
+            overlap_percentage = get_overlap_percentage(peptide_from, peptide_to)
+            if peptide_from.sequence == peptide_to.sequence:
+                continue
+            if overlap_percentage == 0:
+                continue
+            d = (
+                get_length_ratio(peptide_from, peptide_to)
+                + 1 / (overlap_percentage + epsilon)
+                + get_center_distance(peptide_from, peptide_to)
+            )
+            if d <= distance_cutoff:
+                edges.append((i, j, d + epsilon))
+    return edges
+
+
+@pytest.mark.parametrize("block_size", [1_000_000, 7])
+@pytest.mark.parametrize("distance_cutoff", [3, 4])
+def test_pairwise_distances_match_double_loop(block_size, distance_cutoff):
+    peptides = get_peptides()
+    starts = np.array([peptide.start for peptide in peptides])
+    assert len(starts) - len(np.unique(starts)) > 50
+
+    _, sequence_codes = np.unique(
+        [peptide.sequence for peptide in peptides], return_inverse=True
+    )
+    edges_from, edges_to, distances = get_pairwise_distances(
+        starts,
+        np.array([peptide.end for peptide in peptides]),
+        sequence_codes,
+        distance_cutoff=distance_cutoff,
+        block_size=block_size,
+    )
+    edges = list(zip(edges_from.tolist(), edges_to.tolist(), distances.tolist()))
+    assert edges == get_loop_edges(peptides, distance_cutoff)
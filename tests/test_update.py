@@ -0,0 +1,96 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pepnets.PeptideNetwork import PeptideNetwork, get_edge_arrays
+
+
+def make_data(n_proteins=8, random_seed=0):
+    rng = np.random.default_rng(random_seed)
+    amino_acids = list("ACDEFGHIKLMNPQRSTVWY")
+    protein_database = pd.DataFrame(
+        {
+            "Entry Name": [f"P{i}_TEST" for i in range(n_proteins)],
+            "Sequence": [
+                "".join(rng.choice(amino_acids, 200)) for _ in range(n_proteins)
+            ],
+        }
+    )
+    rows = []
+    for protein, sequence in protein_database.values:
+        hotspots = rng.integers(0, 160, size=3)
+        for _ in range(60):
+            start = int(rng.choice(hotspots) + rng.integers(0, 8))
+            length = int(rng.integers(5, 25))
+            for _ in range(1 + (rng.random() < 0.2)):
+                rows.append(
+                    {
+                        "Protein": protein,
+                        "Peptide": sequence[start : start + length],
+                        "Start": start,
+                    }
+                )
+    return protein_database, pd.DataFrame(rows)
+
+
+def get_graph_contents(network):
+    """
+    Returns the nodes and the edges of every protein network, by peptide
+    """
+    nodes, edges = Counter(), Counter()
+    for protein, G in network.protein_networks.items():
+        peptides = network.peptides.get_protein(protein)
+        rows = list(zip(peptides.sequence, peptides.start))
+        nodes.update((protein, *row) for row in rows)
+        for i, j, distance in zip(*get_edge_arrays(G, peptides.id)):
+            edges[(protein, *sorted([rows[i], rows[j]]), round(distance, 10))] += 1
+    return nodes, edges
+
+
+@pytest.mark.parametrize("backend", ["networkx", "igraph"])
+def test_update_matches_create_network(backend):
+    protein_database, datamatrix = make_data()
+    first = datamatrix.sample(frac=0.6, random_state=0)
+
+    updated = PeptideNetwork(first, protein_database, backend=backend)
+    updated.create_network()
+    updated.update(datamatrix)
+    fresh = PeptideNetwork(updated.datamatrix, protein_database, backend=backend)
+    fresh.create_network()
+
+    assert len(updated.peptides) == len(datamatrix.index)
+    assert get_graph_contents(updated) == get_graph_contents(fresh)
+
+
+def test_update_refreshes_partitions():
+    protein_database, datamatrix = make_data()
+    first = datamatrix.iloc[: len(datamatrix.index) // 2]
+
+    network = PeptideNetwork(first, protein_database)
+    network.create_network()
+    network.get_clusters(0.8)
+    dirty = network.update(datamatrix)
+
+    protein = sorted(dirty)[0]
+    peptide_ids, membership = network._get_protein_partition(protein)
+    assert sorted(peptide_ids) == sorted(network.peptides.get_protein(protein).id)
+    assert len(membership) == len(peptide_ids)
+    assert not network.dirty_proteins
+
+
+def test_save_load_keeps_dirty_proteins(tmp_path):
+    protein_database, datamatrix = make_data()
+    first = datamatrix.iloc[: len(datamatrix.index) // 2]
+
+    network = PeptideNetwork(first, protein_database)
+    network.create_network()
+    network.get_clusters(0.8)
+    dirty = network.update(datamatrix)
+    network.save(tmp_path / "network")
+
+    loaded = PeptideNetwork.load(tmp_path / "network", protein_database)
+    assert loaded.dirty_proteins == {(0.8, 42): dirty}
+    n_clusters = len(loaded.get_clusters(0.8).clusters)
+    assert n_clusters == len(network.get_clusters(0.8).clusters)